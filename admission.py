@@ -0,0 +1,189 @@
+"""Module providing admission control for chart renders"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+import metrics
+
+# bars per month of offset, the bar count a render costs roughly linear in
+BARS_PER_MONTH = {False: 21, True: 4.35}
+# longest history a chart can show, larger offsets cost no more
+MAX_BARS = 6000
+# bars of a default daily chart, which costs 1
+REFERENCE_BARS = 190
+# share of a default render that does not depend on the bar count
+FIXED_COST = 0.5
+# a queued request starts as if it arrived this many seconds later per unit of
+# cost and per request its user already has queued, so heavy requests and
+# spammers wait behind normal ones without starving
+COST_DELAY = 2.0
+USER_DELAY = 5.0
+MAX_QUEUE = 64
+# token buckets in cost units: (burst, units refilled per second)
+USER_BUCKET = (6, 0.2)
+GUILD_BUCKET = (40, 2.0)
+# seconds between sweeps dropping the buckets that are full again, an idle
+# full bucket is the same as none
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """rate limit of rate cost units per second with bursts up to capacity"""
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self._capacity = capacity
+        self._rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def allows(self, cost: float) -> bool:
+        """whether cost can be taken now, costs above the capacity need a full bucket"""
+        self._refill()
+        return self._tokens >= min(cost, self._capacity)
+
+    def take(self, cost: float) -> None:
+        """takes cost, at most the capacity so the bucket never goes into debt"""
+        self._refill()
+        self._tokens = max(0.0, self._tokens - min(cost, self._capacity))
+
+    def full(self) -> bool:
+        """whether the bucket has refilled to its capacity"""
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def retry_after(self, cost: float) -> float:
+        """seconds until cost can be taken"""
+        self._refill()
+        return max(0.0, (min(cost, self._capacity) - self._tokens) / self._rate)
+
+
+def estimate_cost(request) -> float:
+    """returns the render cost of request relative to a default daily chart"""
+    bars = min(request.offset * BARS_PER_MONTH[request.weekly], MAX_BARS)
+    scale = ((request.dpi or 100) / 100) ** 2
+    return (FIXED_COST + (1 - FIXED_COST) * bars / REFERENCE_BARS) * scale
+
+
+class RenderScheduler:
+    """bounded priority queue in front of a render pool, admitting requests by
+    per-user and per-guild token buckets and running at most concurrency
+    renders at a time, cheapest and least queued users first"""
+
+    def __init__(
+        self,
+        pool,
+        concurrency: int,
+        max_queue=MAX_QUEUE,
+        user_bucket=USER_BUCKET,
+        guild_bucket=GUILD_BUCKET,
+    ) -> None:
+        self._pool = pool
+        self._concurrency = concurrency
+        self._max_queue = max_queue
+        self._user_bucket = user_bucket
+        self._guild_bucket = guild_bucket
+        self._buckets = {}
+        self._pruned = time.monotonic()
+        self._queue = []
+        self._queued_by_user = {}
+        self._running = 0
+        self._sequence = itertools.count()
+
+    def _bucket(self, key, spec) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*spec)
+        return bucket
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        if now - self._pruned < PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        for key in [key for key, bucket in self._buckets.items() if bucket.full()]:
+            del self._buckets[key]
+
+    def admit(self, requests: list, user, guild=None) -> None:
+        """takes the cost of requests from the buckets of user and guild, raises
+        when they are rate limited or the queue is full. The guild is charged at
+        most a user's burst, so one user cannot drain it for everyone else"""
+        self._prune()
+        if len(self._queue) + len(requests) > self._max_queue:
+            metrics.inc("shed_total", reason="queue_full")
+            raise Exception(
+                f"busy, position {len(self._queue) + 1} is past the queue limit, "
+                "try again in a moment"
+            )
+        cost = min(sum(estimate_cost(request) for request in requests), self._user_bucket[0])
+        buckets = [self._bucket(("user", user), self._user_bucket)]
+        if guild is not None:
+            buckets.append(self._bucket(("guild", guild), self._guild_bucket))
+        for bucket in buckets:
+            if not bucket.allows(cost):
+                metrics.inc("shed_total", reason="rate_limited")
+                raise Exception(
+                    f"Slow down, try again in {bucket.retry_after(cost):.0f}s"
+                )
+        for bucket in buckets:
+            bucket.take(cost)
+
+    async def admit_uncached(self, requests: list, user, guild=None) -> list:
+        """returns the cached image of each request, None for the ones to render,
+        which are admitted like admit does. Cached charts cost nothing"""
+        images = await asyncio.gather(*(self._pool.cached(request) for request in requests))
+        self.admit(
+            [request for request, image in zip(requests, images) if image is None], user, guild
+        )
+        return images
+
+    def enqueue(self, request, user) -> asyncio.Future:
+        """queues request, returns a future of its image"""
+        future = asyncio.get_running_loop().create_future()
+        queued = self._queued_by_user.get(user, 0)
+        start = (
+            time.monotonic() + estimate_cost(request) * COST_DELAY + queued * USER_DELAY
+        )
+        self._queued_by_user[user] = queued + 1
+        heapq.heappush(self._queue, (start, next(self._sequence), request, user, future))
+        metrics.add("queued_renders", 1)
+        self._dispatch()
+        return future
+
+    def position(self, future: asyncio.Future) -> int:
+        """returns how many queued requests go before future's, 0 if it runs"""
+        for item in self._queue:
+            if item[4] is future:
+                return 1 + sum(other < item for other in self._queue)
+        return 0
+
+    def _dispatch(self) -> None:
+        while self._running < self._concurrency and self._queue:
+            _, _, request, user, future = heapq.heappop(self._queue)
+            metrics.add("queued_renders", -1)
+            self._queued_by_user[user] -= 1
+            if not self._queued_by_user[user]:
+                del self._queued_by_user[user]
+            if future.done():
+                continue
+            self._running += 1
+            asyncio.ensure_future(self._run(request, future))
+
+    async def _run(self, request, future: asyncio.Future) -> None:
+        try:
+            image = await self._pool.render(request)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(image)
+        finally:
+            self._running -= 1
+            self._dispatch()
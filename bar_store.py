@@ -0,0 +1,395 @@
+"""Module providing a persistent on-disk OHLCV bar store"""
+
+import datetime as dt
+import logging
+import os
+import threading
+from contextlib import ExitStack
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+import yfinance as yf
+import metrics
+from single_flight import file_lock
+
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bar_store")
+BAR_DTYPE = np.dtype(
+    [
+        ("date", "<i8"),
+        ("open", "<f8"),
+        ("high", "<f8"),
+        ("low", "<f8"),
+        ("close", "<f8"),
+        ("volume", "<f8"),
+    ]
+)
+MARKET_TZ = ZoneInfo("America/New_York")
+MARKET_OPEN = dt.time(9, 30)
+MARKET_CLOSE = dt.time(16, 0)
+# bars keep getting revised for a while after the close
+CLOSE_SETTLE = dt.timedelta(minutes=20)
+# max age of stored bars while the market is open
+OPEN_MAX_AGE = dt.timedelta(minutes=1)
+
+_download_lock = threading.Lock()
+# bars of these intervals are resampled from the stored daily bars instead of
+# downloaded, labelled with the first day of the period like yahoo's. The rules
+# are the pandas equivalents of resample()
+RESAMPLE_RULES = {"1wk": "W-MON", "1mo": "MS"}
+AGGREGATION = {"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum"}
+# most trading days in a resampled period
+MAX_DAYS_PER_PERIOD = {"1wk": 5, "1mo": 23}
+
+logger = logging.getLogger(__name__)
+
+
+def market_is_open(now=None) -> bool:
+    """returns True during regular US market hours"""
+    now = (now or dt.datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+
+def last_close(now=None) -> dt.datetime:
+    """returns the most recent regular session close at or before now"""
+    now = (now or dt.datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    day = now.date()
+    if now.time() < MARKET_CLOSE:
+        day -= dt.timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= dt.timedelta(days=1)
+    return dt.datetime.combine(day, MARKET_CLOSE, tzinfo=MARKET_TZ)
+
+
+def is_stale(fetched_at: dt.datetime, now=None) -> bool:
+    """staleness policy: short max age while the market is open, otherwise
+    stale only if the bars were fetched before the last close had settled"""
+    now = (now or dt.datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    if now - fetched_at <= OPEN_MAX_AGE:
+        return False
+    return market_is_open(now) or fetched_at < last_close(now) + CLOSE_SETTLE
+
+
+# bytes read to find the .npy header of a bar file and the dtype it must declare
+_HEAD_SIZE = 256
+_DESCR = repr(BAR_DTYPE.descr).encode()
+
+
+def _path(ticker: str, interval: str) -> str:
+    name = ticker.upper().replace(os.sep, "_")
+    return os.path.join(STORE_DIR, f"{name}_{interval}.npy")
+
+
+def _fetched_at(path: str) -> dt.datetime:
+    return dt.datetime.fromtimestamp(os.path.getmtime(path), tz=MARKET_TZ)
+
+
+def _to_records(df: pd.DataFrame) -> np.ndarray:
+    bars = np.empty(len(df), dtype=BAR_DTYPE)
+    bars["date"] = df.index.values.astype("datetime64[ns]").astype("<i8")
+    for col in BAR_DTYPE.names[1:]:
+        bars[col] = df[col].to_numpy(dtype="<f8")
+    return bars
+
+
+def _to_frame(bars: np.ndarray) -> pd.DataFrame:
+    df = pd.DataFrame(
+        {col: np.array(bars[col]) for col in BAR_DTYPE.names[1:]},
+        index=pd.DatetimeIndex(np.array(bars["date"]).astype("datetime64[ns]")),
+    )
+    df.index.name = "date"
+    return df
+
+
+def _normalize(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.tz_localize(None)
+    df.columns = [col.lower() for col in df.columns]
+    return df[list(BAR_DTYPE.names[1:])]
+
+
+def _save(path: str, bars: np.ndarray) -> None:
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, bars)
+    os.replace(tmp_path, path)
+
+
+def _load(path: str):
+    try:
+        return np.load(path, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _load_tail(path: str, count: int):
+    """returns the last count bars stored at path, None if there are none.
+    Reads only those bars: the header of a bar file is not parsed, which takes
+    longer than reading a few hundred bars"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(_HEAD_SIZE)
+            # .npy format version 1 stores the header length in 2 bytes, later ones in 4
+            size = 2 if head[6:7] == b"\x01" else 4
+            offset = 8 + size + int.from_bytes(head[8 : 8 + size], "little")
+            if not head.startswith(b"\x93NUMPY") or _DESCR not in head[:offset]:
+                return _load(path)
+            rows = (os.fstat(f.fileno()).st_size - offset) // BAR_DTYPE.itemsize
+            count = min(count, rows)
+            f.seek(offset + (rows - count) * BAR_DTYPE.itemsize)
+            return np.frombuffer(f.read(count * BAR_DTYPE.itemsize), dtype=BAR_DTYPE)
+    except FileNotFoundError:
+        return None
+
+
+def _fresh(path: str):
+    """returns the stored bars at path if they are fresh, otherwise None"""
+    stored = _load(path)
+    if stored is not None and not is_stale(_fetched_at(path)):
+        return stored
+    return None
+
+
+def _anchor_date(stored: np.ndarray) -> dt.date:
+    # refetch from the last complete stored bar, it is used to detect
+    # split/dividend re-adjustments of the whole history
+    return pd.Timestamp(stored[-2]["date"]).date()
+
+
+def _merge(stored: np.ndarray, df: pd.DataFrame):
+    """merges freshly fetched bars into the stored ones, returns None if the
+    overlapping bar shows the whole history was re-adjusted. The refetch starts
+    at a stored bar, so an empty df means the fetch failed and stored is returned"""
+    if df.empty:
+        return stored
+    new = _to_records(_normalize(df))
+    anchor = stored[-2]
+    overlap = new[new["date"] == anchor["date"]]
+    if len(overlap) == 0 or not np.isclose(overlap["close"][0], anchor["close"]):
+        return None
+    return np.concatenate([stored[stored["date"] < new["date"][0]], new])
+
+
+def _failed(ticker: str, interval: str) -> None:
+    metrics.inc("upstream_failures_total", upstream="yfinance")
+    logger.warning("no %s bars fetched for %s, keeping the stored bars", interval, ticker)
+
+
+def _fetch(ticker: str, interval: str, period: str, stored) -> np.ndarray:
+    """returns the refreshed bars of ticker, stored itself if the fetch failed"""
+    tick = yf.Ticker(ticker)
+    if stored is not None and len(stored) >= 2:
+        bars = _merge(stored, tick.history(start=_anchor_date(stored), interval=interval))
+        if bars is stored:
+            _failed(ticker, interval)
+            return stored
+        if bars is not None:
+            return bars
+    df = tick.history(period=period, interval=interval)
+    if df.empty:
+        if stored is not None:
+            _failed(ticker, interval)
+        return stored
+    return _to_records(_normalize(df))
+
+
+def _download(tickers: list, interval: str, **kwargs) -> dict:
+    """downloads several tickers with one batched yfinance call"""
+    # yf.download keeps its results in module globals, calls must not overlap
+    with _download_lock:
+        data = yf.download(
+            tickers,
+            interval=interval,
+            group_by="ticker",
+            auto_adjust=True,
+            progress=False,
+            **kwargs,
+        )
+    if len(tickers) == 1:
+        return {tickers[0]: data}
+    frames = {}
+    for ticker in set(data.columns.get_level_values(0)):
+        frames[ticker] = data[ticker].dropna(how="all")
+    return frames
+
+
+def _store(path: str, bars, stored) -> np.ndarray:
+    """saves fetched bars, bars is stored when the fetch failed: the file keeps
+    its mtime so it stays stale and the next request retries"""
+    if bars is None:
+        return np.empty(0, dtype=BAR_DTYPE)
+    if bars is not stored:
+        _save(path, bars)
+    return bars
+
+
+def _period_starts(dates: np.ndarray, interval: str) -> np.ndarray:
+    """returns the monday of the week or the first day of the month of dates"""
+    days = dates.astype("datetime64[D]")
+    if interval == "1wk":
+        # 1970-01-01 was a thursday
+        return days - (days.astype(np.int64) + 3) % 7
+    return days.astype("datetime64[M]").astype("datetime64[D]")
+
+
+def resample(df: pd.DataFrame, interval: str) -> pd.DataFrame:
+    """aggregates daily bars to interval bars, the last one covers the days of
+    the current period so far. Equivalent to
+    df.resample(RESAMPLE_RULES[interval], label="left", closed="left").agg(AGGREGATION)
+    without the empty periods, but an order of magnitude faster"""
+    if df.empty:
+        return df[list(AGGREGATION)].copy()
+    periods = _period_starts(df.index.values, interval)
+    starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+    ends = np.r_[starts[1:], len(df)] - 1
+    resampled = pd.DataFrame(
+        {
+            "open": df["open"].to_numpy()[starts],
+            "high": np.fmax.reduceat(df["high"].to_numpy(), starts),
+            "low": np.fmin.reduceat(df["low"].to_numpy(), starts),
+            "close": df["close"].to_numpy()[ends],
+            "volume": np.add.reduceat(df["volume"].to_numpy(), starts),
+        },
+        index=pd.DatetimeIndex(periods[starts].astype("datetime64[ns]")),
+    )
+    resampled.index.name = "date"
+    return resampled
+
+
+def _bars(ticker: str, interval: str, period: str) -> np.ndarray:
+    """returns the stored bars of ticker, only fetching bars newer than the
+    stored ones when the stored bars are stale"""
+    path = _path(ticker, interval)
+    stored = _fresh(path)
+    if stored is not None:
+        return stored
+    with file_lock(f"{path}.lock"):
+        # another process or thread may have refreshed the bars while we waited
+        stored = _fresh(path)
+        if stored is not None:
+            metrics.inc("coalesced_total", flight="bars")
+            return stored
+        stored = _load(path)
+        return _store(path, _fetch(ticker, interval, period, stored), stored)
+
+
+def get_bars(ticker: str, interval="1d", period="max") -> pd.DataFrame:
+    """returns the OHLCV bars for ticker, only fetching bars newer than the
+    stored ones when the stored bars are stale"""
+    if interval in RESAMPLE_RULES:
+        return resample(get_bars(ticker, "1d", period), interval)
+    return _to_frame(_bars(ticker, interval, period))
+
+
+def last_bars(ticker: str, count: int, interval="1d") -> pd.DataFrame:
+    """returns the last count bars of get_bars(ticker, interval), refreshing
+    them the same way, but only converts those bars and for resampled
+    intervals only aggregates the days of the last count periods"""
+    if interval in RESAMPLE_RULES:
+        # one more period than asked for, the first one may be cut short
+        days = (count + 1) * MAX_DAYS_PER_PERIOD[interval]
+        return resample(last_bars(ticker, days, "1d"), interval).iloc[-count:]
+    return _to_frame(_bars(ticker, interval, "max")[-count:])
+
+
+def get_many(tickers, interval="1d", period="max") -> dict:
+    """returns the bars of several tickers keyed by upper-case ticker, the
+    stale ones are fetched with one batched call for tickers without stored
+    bars and one for incremental updates. Tickers without data are left out"""
+    if interval in RESAMPLE_RULES:
+        bars = get_many(tickers, "1d", period)
+        return {ticker: resample(df, interval) for ticker, df in bars.items()}
+    result = {}
+    stale = []
+    for ticker in sorted({ticker.upper() for ticker in tickers}):
+        stored = _fresh(_path(ticker, interval))
+        if stored is not None:
+            result[ticker] = _to_frame(stored)
+        else:
+            stale.append(ticker)
+    with ExitStack() as locks:
+        # locks are taken in sorted order so concurrent batches cannot deadlock
+        for ticker in stale:
+            locks.enter_context(file_lock(f"{_path(ticker, interval)}.lock"))
+        _fetch_many(stale, interval, period, result)
+    return {ticker: df for ticker, df in result.items() if not df.empty}
+
+
+def _fetch_many(tickers: list, interval: str, period: str, result: dict) -> None:
+    """fetches the stale bars of tickers into result, the bar files must be locked"""
+    missing = []
+    updates = {}
+    for ticker in tickers:
+        path = _path(ticker, interval)
+        stored = _fresh(path)
+        if stored is not None:
+            metrics.inc("coalesced_total", flight="bars")
+            result[ticker] = _to_frame(stored)
+            continue
+        stored = _load(path)
+        if stored is None or len(stored) < 2:
+            missing.append(ticker)
+        else:
+            updates[ticker] = stored
+    if missing:
+        frames = _download(missing, interval, period=period)
+        for ticker in missing:
+            df = frames.get(ticker)
+            bars = _to_records(_normalize(df)) if df is not None and not df.empty else None
+            result[ticker] = _to_frame(_store(_path(ticker, interval), bars, None))
+    if updates:
+        start = min(_anchor_date(stored) for stored in updates.values())
+        frames = _download(list(updates), interval, start=start)
+        for ticker, stored in updates.items():
+            df = frames.get(ticker)
+            if df is None or df.empty:
+                # not in the batch response, the file stays stale and is retried
+                _failed(ticker, interval)
+                result[ticker] = _to_frame(stored)
+                continue
+            bars = _merge(stored, df)
+            if bars is None:
+                bars = _fetch(ticker, interval, period, None)
+            result[ticker] = _to_frame(_store(_path(ticker, interval), bars, stored))
+
+
+def stored_tickers(interval="1d") -> list:
+    """returns the tickers with stored bars of interval"""
+    suffix = f"_{interval}.npy"
+    try:
+        names = os.listdir(STORE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(name[: -len(suffix)] for name in names if name.endswith(suffix))
+
+
+def load_recent(tickers, count: int, interval="1d") -> tuple:
+    """returns the upper-case tickers with stored bars and one array of their
+    last count stored bars, one row per ticker. Rows with fewer bars start with
+    nan bars dated 0. The stored bars are read as they are, fresh or not"""
+    found = []
+    rows = []
+    for ticker in dict.fromkeys(ticker.upper() for ticker in tickers):
+        stored = _load_tail(_path(ticker, interval), count)
+        if stored is not None and len(stored):
+            found.append(ticker)
+            rows.append(stored[-count:])
+    bars = np.zeros((len(rows), count), dtype=BAR_DTYPE)
+    for col in BAR_DTYPE.names[1:]:
+        bars[col] = np.nan
+    for row, stored in zip(bars, rows):
+        row[count - len(stored) :] = stored
+    return found, bars
+
+
+def last_bar(ticker: str, interval="1d"):
+    """returns the last stored bar as a string if the stored bars are fresh,
+    otherwise None. It changes whenever the charted data changes, including
+    intraday updates of the current bar"""
+    if interval in RESAMPLE_RULES:
+        # resampled bars change exactly when the daily bars do
+        interval = "1d"
+    stored = _fresh(_path(ticker, interval))
+    if stored is None or len(stored) == 0:
+        return None
+    bar = stored[-1]
+    return f"{pd.Timestamp(bar['date']).isoformat()}:{bar['close']!r}:{bar['volume']!r}"
@@ -0,0 +1,207 @@
+"""Module providing headless batch chart rendering
+
+Renders every combination of tickers, styles, timeframes and offsets into an
+output directory, fetching the bars and fundamentals in batches and rendering
+on a process pool across all cores:
+
+    python batch_render.py tickers.txt --styles qullamaggie ibd --timeframes daily weekly --out charts/
+
+A manifest in the output directory records the last bar each chart shows, a
+rerun skips the charts whose data did not change and renders the rest.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from prerender import load_watchlist
+from render_pool import ChartRequest, RenderPool, image_extension, request_key
+
+MANIFEST = "manifest.json"
+TIMEFRAMES = {"daily": False, "weekly": True}
+# months of history when no offsets are given, matching !chart and !wchart
+DEFAULT_OFFSETS = {False: 9, True: 40}
+BATCH_SIZE = 50
+
+logger = logging.getLogger(__name__)
+
+
+def chart_name(request: ChartRequest) -> str:
+    """returns the output file name of request without extension"""
+    return "_".join(
+        [
+            request.ticker.upper(),
+            "1W" if request.weekly else "1D",
+            request.style.lower(),
+            str(request.offset),
+        ]
+    )
+
+
+def load_manifest(out_dir: str) -> dict:
+    """returns the manifest of out_dir: the output file, render key, last bar
+    shown and missing optional data per chart name"""
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(out_dir: str, manifest: dict) -> None:
+    path = os.path.join(out_dir, MANIFEST)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+class BatchRenderer:
+    """renders chart packs into an output directory on a render pool"""
+
+    def __init__(self, out_dir: str, pool: RenderPool, batch_size=BATCH_SIZE) -> None:
+        self._out_dir = out_dir
+        self._pool = pool
+        self._batch_size = batch_size
+        self._manifest = load_manifest(out_dir)
+
+    def _up_to_date(self, request: ChartRequest, last_bar) -> bool:
+        entry = self._manifest.get(chart_name(request))
+        return (
+            last_bar is not None
+            and entry is not None
+            and entry["last_bar"] == last_bar
+            and entry["key"] == request_key(request)
+            and not entry.get("missing")
+            and os.path.exists(os.path.join(self._out_dir, entry["file"]))
+        )
+
+    async def _prefetch(self, tickers: list, intervals: set) -> None:
+        for interval in sorted(intervals):
+            await self._pool.prefetch(tickers, interval)
+
+    def _write(self, request: ChartRequest, image: bytes, last_bar) -> None:
+        name = chart_name(request)
+        file_name = f"{name}.{image_extension(image)}"
+        with open(os.path.join(self._out_dir, file_name), "wb") as f:
+            f.write(image)
+        self._manifest[name] = {
+            "file": file_name,
+            "key": request_key(request),
+            "last_bar": last_bar,
+            # rendered without this data, a rerun renders the chart again
+            "missing": list(getattr(image, "missing", ())),
+        }
+
+    async def run(self, tickers: list, combinations: list, **kwargs) -> dict:
+        """renders the (weekly, style, offset) combinations of every ticker that
+        are not up to date, kwargs are further ChartRequest fields. Returns the
+        rendered, skipped and failed counts and the failure of each failed chart"""
+        import bar_store
+
+        os.makedirs(self._out_dir, exist_ok=True)
+        intervals = {"1wk" if weekly else "1d" for weekly, _, _ in combinations}
+        batches = [
+            tickers[i : i + self._batch_size]
+            for i in range(0, len(tickers), self._batch_size)
+        ]
+        result = {"rendered": 0, "skipped": 0, "failed": 0, "failures": {}}
+        start = time.perf_counter()
+        prefetch = None
+        for i, batch in enumerate(batches):
+            if prefetch is None:
+                prefetch = asyncio.ensure_future(self._prefetch(batch, intervals))
+            await prefetch
+            # the next batch downloads while this one renders
+            if i + 1 < len(batches):
+                prefetch = asyncio.ensure_future(self._prefetch(batches[i + 1], intervals))
+            requests = []
+            for ticker in batch:
+                for weekly, style, offset in combinations:
+                    request = ChartRequest(ticker, weekly, style, offset, **kwargs)
+                    if self._up_to_date(request, bar_store.last_bar(ticker, request.interval)):
+                        result["skipped"] += 1
+                    else:
+                        requests.append(request)
+            for request, image in zip(requests, await self._pool.render_many(requests)):
+                if isinstance(image, Exception):
+                    result["failed"] += 1
+                    result["failures"][chart_name(request)] = str(image)
+                    continue
+                self._write(request, image, bar_store.last_bar(request.ticker, request.interval))
+                result["rendered"] += 1
+            save_manifest(self._out_dir, self._manifest)
+            done = sum(result[key] for key in ("rendered", "skipped", "failed"))
+            logger.info(
+                "%d/%d charts, %.1f rendered charts/s",
+                done,
+                len(tickers) * len(combinations),
+                result["rendered"] / (time.perf_counter() - start),
+            )
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+
+def _main() -> int:
+    import plot_lib as pl
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("tickers", help="file with one ticker per line, # starts a comment")
+    parser.add_argument("--styles", nargs="+", default=["qullamaggie"])
+    parser.add_argument(
+        "--timeframes", nargs="+", choices=sorted(TIMEFRAMES), default=["daily"]
+    )
+    parser.add_argument(
+        "--offsets", nargs="+", type=int, help="months of history, default 9 daily and 40 weekly"
+    )
+    parser.add_argument("--format", dest="image_format", choices=pl.IMAGE_FORMATS)
+    parser.add_argument("--dpi", type=int)
+    parser.add_argument("--engine", choices=pl.RENDER_ENGINES)
+    parser.add_argument("--out", default="charts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    unknown = [style for style in args.styles if style.lower() not in pl.STYLES]
+    if unknown:
+        parser.error(f"unknown styles {unknown}, defined styles are {sorted(pl.STYLES)}")
+    tickers = load_watchlist(args.tickers)
+    combinations = [
+        (weekly, style.lower(), offset)
+        for weekly in dict.fromkeys(TIMEFRAMES[timeframe] for timeframe in args.timeframes)
+        for style in args.styles
+        for offset in args.offsets or [DEFAULT_OFFSETS[weekly]]
+    ]
+
+    async def run() -> dict:
+        # the renders are written to files, a rendered-chart cache would only duplicate them
+        pool = RenderPool(max_workers=args.workers, warm_up=False)
+        try:
+            renderer = BatchRenderer(args.out, pool, args.batch_size)
+            return await renderer.run(
+                tickers,
+                combinations,
+                image_format=args.image_format,
+                dpi=args.dpi,
+                engine=args.engine,
+            )
+        finally:
+            pool.shutdown()
+
+    result = asyncio.run(run())
+    for name, error in sorted(result["failures"].items()):
+        print(f"FAILED {name}: {error}", file=sys.stderr)
+    print(
+        f"{result['rendered']} rendered, {result['skipped']} up to date, "
+        f"{result['failed']} failed in {result['seconds']:.1f}s "
+        f"({result['rendered'] / max(result['seconds'], 1e-9):.2f} charts/s)"
+    )
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,413 @@
+"""Module providing offline chart benchmarks
+
+The benchmarks run on the fixtures in bench_fixtures/ and never touch the
+network: OHLCV bars in the bar store format (bars_1d.npy, weekly bars are
+resampled from them), a tick.info payload (info.json), a finviz quote page
+(finviz_quote.html) and screener page (finviz_screener.html). `python benchmark.py record <ticker>` replaces them with
+live recordings, `python benchmark.py record --synthetic` regenerates
+random-walk daily bars with weekly bars aggregated by pandas. `python
+benchmark.py parity` compares the resampled weekly bars with the weekly bars
+recorded in bars_1wk.npy, yahoo's or pandas'.
+
+    python benchmark.py run --output new.json --baseline old.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image
+from zigzag.core import peak_valley_pivots
+import bar_store
+import indicators as ind
+import plot_lib as pl
+import utils as ut
+from fundamentals import parse_screener
+from scraper import parse_finviz
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+# (timeframe, visible bars): the default offsets and long offsets
+CASES = [("daily", 190), ("daily", 1260), ("weekly", 175), ("weekly", 1040)]
+DEFAULT_THRESHOLD = 0.25
+
+
+def _time(func, repeat: int, setup=None) -> dict:
+    """returns the median and min milliseconds of func over repeat runs,
+    func gets the result of setup which is not timed"""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"median_ms": times[len(times) // 2] * 1000, "min_ms": times[0] * 1000}
+
+
+def _fixture(name: str) -> str:
+    return os.path.join(FIXTURES_DIR, name)
+
+
+def load_fixture_bars(interval: str):
+    """returns the recorded bars of interval as a frame, resampled from the
+    daily bars like the bar store does"""
+    if interval in bar_store.RESAMPLE_RULES:
+        return bar_store.resample(load_fixture_bars("1d"), interval)
+    return bar_store._to_frame(np.load(_fixture(f"bars_{interval}.npy"), mmap_mode="r"))
+
+
+def weekly_parity(rtol=1e-3) -> dict:
+    """compares the weekly bars resampled from the recorded daily bars with
+    the recorded weekly bars over the weeks both cover, the current
+    (partial) week excluded"""
+    resampled = load_fixture_bars("1wk")
+    recorded = bar_store._to_frame(np.load(_fixture("bars_1wk.npy"), mmap_mode="r"))
+    weeks = resampled.index.intersection(recorded.index)[:-1]
+    result = {"weeks": len(weeks), "missing": len(recorded.index[:-1].difference(weeks))}
+    mismatched = np.zeros(len(weeks), dtype=bool)
+    for col in bar_store.AGGREGATION:
+        a = resampled.loc[weeks, col].to_numpy()
+        b = recorded.loc[weeks, col].to_numpy()
+        error = np.abs(a - b) / np.maximum(np.abs(b), 1e-9)
+        result[f"{col}_max_rel_error"] = float(error.max()) if len(weeks) else 0.0
+        mismatched |= error > rtol
+    result["mismatched"] = int(mismatched.sum())
+    return result
+
+
+def load_fixture_frame(weekly: bool, bars: int, names) -> "pd.DataFrame":
+    """returns the last bars of the fixture with the named indicators and meta,
+    shaped like get_stock_data's result"""
+    df = load_fixture_bars("1wk" if weekly else "1d")
+    df = df.iloc[-(bars + ind.warmup(names)) :].copy()
+    df["ticker"] = "TEST"
+    ind.add_indicators(df, names)
+    with open(_fixture("info.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    df["short_name"] = meta["shortName"].replace(".", "")
+    df["industry"] = meta["industry"]
+    df["sector"] = meta["sector"]
+    return df.iloc[-bars:]
+
+
+def bench_stages(repeat=3, styles=None, cases=None) -> dict:
+    """times every pipeline stage for every style and case, keyed by
+    stage|style|timeframe|bars"""
+    results = {}
+    with open(_fixture("finviz_quote.html"), "rb") as f:
+        html = f.read()
+    finviz = parse_finviz(html, "test")
+    results["finviz_parse|-|-|-"] = _time(lambda: parse_finviz(html, "test"), repeat)
+    with open(_fixture("finviz_screener.html"), "rb") as f:
+        screener = f.read()
+    results["screener_parse|-|-|-"] = _time(lambda: parse_screener(screener), repeat)
+    for interval in ("1d", "1wk"):
+        timeframe = "daily" if interval == "1d" else "weekly"
+        results[f"bars|-|{timeframe}|all"] = _time(
+            lambda: load_fixture_bars(interval), repeat
+        )
+    for name in styles or pl.STYLES:
+        for timeframe, bars in cases or CASES:
+            weekly = timeframe == "weekly"
+            config = pl.get_style(name)
+            config["weekly"] = weekly
+            names = pl.get_required_indicators(config)
+            df = load_fixture_frame(weekly, bars, names)
+            raw = load_fixture_bars("1wk" if weekly else "1d").iloc[
+                -(bars + ind.warmup(names)) :
+            ]
+            high, low = np.array(df.high), np.array(df.low)
+            rvol = df["rvol"].to_numpy()
+            key = f"{name}|{timeframe}|{bars}"
+
+            results[f"indicators|{key}"] = _time(
+                lambda frame: ind.add_indicators(frame, names),
+                repeat,
+                setup=lambda: (raw.copy(),),
+            )
+            results[f"pivots|{key}"] = _time(
+                lambda: (
+                    peak_valley_pivots(high, 0.1, -0.1),
+                    peak_valley_pivots(low, 0.1, -0.1),
+                ),
+                repeat,
+            )
+            results[f"rvol|{key}"] = _time(lambda: pl._get_rvol_peaks(rvol), repeat)
+
+            def plot(template):
+                pl._plot_candles(df, config, *template[1:3])
+                pl._release_template(config, template)
+
+            results[f"mpf_plot|{key}"] = _time(
+                plot, repeat, setup=lambda: (pl._acquire_template(config),)
+            )
+            template = pl._acquire_template(config)
+            pl._draw_chart(df.copy(), config, finviz, *template[:3])
+            results[f"savefig|{key}"] = _time(
+                lambda: pl._encode_figure(
+                    template[0], config.get("image_format", "png"), config.get("dpi")
+                ),
+                repeat,
+            )
+            pl._release_template(config, template)
+            results[f"render|{key}"] = _time(
+                lambda: pl._create_chart_with_config(df.copy(), config, finviz), repeat
+            )
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold=DEFAULT_THRESHOLD) -> list:
+    """returns (key, baseline ms, ms) of stages that got slower than threshold"""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]["median_ms"]
+        if result["median_ms"] > base * (1 + threshold):
+            regressions.append((key, base, result["median_ms"]))
+    return regressions
+
+
+def bench_figure_templates(repeat=5) -> dict:
+    """compares the per-chart figure setup and full render of freshly built
+    figures against reused figure templates, per style"""
+    results = {}
+    for name in pl.STYLES:
+        config = pl.get_style(name)
+        df = ut.get_synthetic_stock_data(
+            bars=190, indicators=pl.get_required_indicators(config)
+        )
+
+        def fresh_setup():
+            template = pl._new_template(config)
+            pl._set_tick_params(*template[1:3])
+            plt.close(template[0])
+
+        def template_setup():
+            pl._release_template(config, pl._acquire_template(config))
+
+        def render():
+            pl._create_chart_with_config(df.copy(), config)
+
+        pl.FIGURE_TEMPLATES = False
+        fresh = {"setup": _time(fresh_setup, repeat), "render": _time(render, repeat)}
+        pl.FIGURE_TEMPLATES = True
+        render()
+        reused = {"setup": _time(template_setup, repeat), "render": _time(render, repeat)}
+        results[name] = {"fresh": fresh, "template": reused}
+    return results
+
+
+def _pixel_diff(a: bytes, b: bytes, tolerance=32) -> float:
+    """returns the share of pixels of two images differing by more than
+    tolerance in any channel, 1 when their sizes differ"""
+    a = np.asarray(Image.open(io.BytesIO(a)).convert("RGB"), dtype=np.int16)
+    b = np.asarray(Image.open(io.BytesIO(b)).convert("RGB"), dtype=np.int16)
+    if a.shape != b.shape:
+        return 1.0
+    return float((np.abs(a - b).max(axis=2) > tolerance).mean())
+
+
+def bench_engines(repeat=3, styles=None, cases=None) -> dict:
+    """compares the bar plotting and full render latency, the peak python
+    allocations of a render and the rendered pixels of every render engine,
+    per style and case"""
+    results = {}
+    for name in styles or pl.STYLES:
+        for timeframe, bars in cases or CASES:
+            config = pl.get_style(name)
+            config["weekly"] = timeframe == "weekly"
+            config["image_format"] = "png"
+            df = load_fixture_frame(
+                config["weekly"], bars, pl.get_required_indicators(config)
+            )
+            result = {}
+            images = {}
+            for engine in pl.RENDER_ENGINES:
+                config["engine"] = engine
+
+                def plot(template):
+                    pl._ENGINES[engine](df, config, *template[1:3])
+                    pl._release_template(config, template)
+
+                images[engine] = pl._create_chart_with_config(df.copy(), config)
+                tracemalloc.start()
+                pl._create_chart_with_config(df.copy(), config)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                result[engine] = {
+                    "plot": _time(plot, repeat, setup=lambda: (pl._acquire_template(config),)),
+                    "render": _time(
+                        lambda: pl._create_chart_with_config(df.copy(), config), repeat
+                    ),
+                    "peak_mb": peak / 1e6,
+                }
+            result["pixel_diff"] = _pixel_diff(*images.values())
+            results[f"{name}|{timeframe}|{bars}"] = result
+    return results
+
+
+def bench_scan(tickers=3000, bars=300, repeat=3, seed=0) -> dict:
+    """times scans of a universe of tickers, windows of bars fixture bars at
+    random offsets all ending on the same date, stored in a temporary bar store.
+    Returns the median and min milliseconds of a scan and the max relative
+    error of its indicators against add_indicators over the stored bars"""
+    import tempfile
+    import scan
+
+    fixture = np.load(_fixture("bars_1d.npy"))
+    rng = np.random.default_rng(seed)
+    names = list(ind.INDICATORS)
+    filters = [f"{name}>0" for name in names]
+    store_dir = bar_store.STORE_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bar_store.STORE_DIR = tmp_dir
+        try:
+            for i in range(tickers):
+                start = rng.integers(0, len(fixture) - bars)
+                window = fixture[start : start + bars].copy()
+                window["date"] = fixture["date"][-bars:]
+                bar_store._save(bar_store._path(f"T{i}", "1d"), window)
+            result = _time(lambda: scan.scan(filters, limit=tickers), repeat)
+            matches = scan.scan(filters, limit=tickers)["matches"]
+            error = 0.0
+            for match in matches[:: max(len(matches) // 50, 1)]:
+                stored = bar_store._load(bar_store._path(match["ticker"], "1d"))
+                df = ind.add_indicators(bar_store._to_frame(stored), names)
+                for name in names:
+                    expected = df[name].iloc[-1]
+                    error = max(error, abs(match[name] - expected) / abs(expected))
+        finally:
+            bar_store.STORE_DIR = store_dir
+    result["max_rel_error"] = error
+    return result
+
+
+def record(ticker: str) -> None:
+    """records live fixtures of ticker"""
+    import yfinance as yf
+    from scraper import http_get
+
+    for interval in ("1d", "1wk"):
+        df = bar_store._normalize(yf.Ticker(ticker).history(period="max", interval=interval))
+        np.save(_fixture(f"bars_{interval}.npy"), bar_store._to_records(df))
+    with open(_fixture("info.json"), "w", encoding="utf-8") as f:
+        json.dump(yf.Ticker(ticker).info, f, indent=2, default=str)
+    response = http_get(f"https://finviz.com/quote.ashx?t={ticker}")
+    if response is None or response.status_code != 200:
+        raise Exception(f"Could not record finviz quote page of {ticker}")
+    with open(_fixture("finviz_quote.html"), "wb") as f:
+        f.write(response.content)
+
+
+def record_synthetic(seed=0) -> None:
+    """writes random-walk daily bar fixtures and weekly ones aggregated from them
+    by pandas, independently of bar_store.resample which parity checks"""
+    df = ut.get_synthetic_stock_data(bars=6000, indicators=[], seed=seed)
+    np.save(_fixture("bars_1d.npy"), bar_store._to_records(df))
+    weekly = (
+        df[list(bar_store.AGGREGATION)]
+        .resample("W-MON", label="left", closed="left")
+        .agg(bar_store.AGGREGATION)
+        .dropna(subset=["open"])
+    )
+    np.save(_fixture("bars_1wk.npy"), bar_store._to_records(weekly))
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="time every pipeline stage")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--styles", nargs="*")
+    run.add_argument("--output", help="write the results as json")
+    run.add_argument("--baseline", help="json results to compare against")
+    run.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    commands.add_parser("templates", help="fresh figures vs figure templates")
+    commands.add_parser("parity", help="resampled vs recorded weekly bars")
+    engines = commands.add_parser("engines", help="mplfinance vs collection render engine")
+    engines.add_argument("--repeat", type=int, default=3)
+    engines.add_argument("--styles", nargs="*")
+    scan_ = commands.add_parser("scan", help="vectorized scan of a synthetic universe")
+    scan_.add_argument("--tickers", type=int, default=3000)
+    scan_.add_argument("--repeat", type=int, default=3)
+    rec = commands.add_parser("record", help="record fixtures")
+    rec.add_argument("ticker", nargs="?")
+    rec.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        if args.synthetic:
+            record_synthetic()
+        else:
+            record(args.ticker)
+        return 0
+    if args.command == "parity":
+        result = weekly_parity()
+        for key, value in result.items():
+            print(f"{key:25s} {value}")
+        return 1 if result["mismatched"] or result["missing"] else 0
+    if args.command == "engines":
+        for key, result in bench_engines(args.repeat, args.styles).items():
+            mpf_, fast = result["mpf"], result["fast"]
+            print(
+                f"{key:28s} plot {mpf_['plot']['median_ms']:7.1f}ms -> "
+                f"{fast['plot']['median_ms']:6.1f}ms   render "
+                f"{mpf_['render']['median_ms']:7.1f}ms -> {fast['render']['median_ms']:6.1f}ms"
+                f"   peak {mpf_['peak_mb']:5.1f}MB -> {fast['peak_mb']:5.1f}MB"
+                f"   pixels differing {result['pixel_diff']:.2%}"
+            )
+        return 0
+    if args.command == "scan":
+        result = bench_scan(args.tickers, repeat=args.repeat)
+        print(
+            f"scan of {args.tickers} tickers {result['median_ms']:.1f}ms "
+            f"(min {result['min_ms']:.1f}ms), indicators max rel error "
+            f"{result['max_rel_error']:.2e} vs add_indicators"
+        )
+        return 0
+    if args.command == "templates":
+        for style, result in bench_figure_templates().items():
+            print(
+                f"{style:12s} setup {result['fresh']['setup']['median_ms']:7.1f}ms -> "
+                f"{result['template']['setup']['median_ms']:6.1f}ms   render "
+                f"{result['fresh']['render']['median_ms']:7.1f}ms -> "
+                f"{result['template']['render']['median_ms']:6.1f}ms"
+            )
+        return 0
+
+    repeat = getattr(args, "repeat", 3)
+    results = bench_stages(repeat=repeat, styles=getattr(args, "styles", None))
+    for key, result in results.items():
+        print(f"{key:45s} {result['median_ms']:9.2f}ms")
+    if getattr(args, "output", None):
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "time": time.time(),
+                    "repeat": repeat,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if getattr(args, "baseline", None):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, base, new in regressions:
+            print(f"REGRESSION {key}: {base:.2f}ms -> {new:.2f}ms")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
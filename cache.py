@@ -0,0 +1,153 @@
+"""Module providing caches"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from single_flight import file_lock
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+
+class TTLCache:
+    """json-serializable values kept in memory and on disk until they expire"""
+
+    def __init__(self, name: str, ttl: float) -> None:
+        self._ttl = ttl
+        self._name = name
+        self._dir = os.path.join(CACHE_DIR, name)
+        self._memory = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._dir, f"{key.replace(os.sep, '_')}.json")
+
+    def get(self, key: str):
+        """returns the cached value for key or None if missing or expired"""
+        entry = self._memory.get(key)
+        if entry is None:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                metrics.inc("cache_requests_total", cache=self._name, result="miss")
+                return None
+            self._memory[key] = entry
+        if entry["expires"] < time.time():
+            self._memory.pop(key, None)
+            metrics.inc("cache_requests_total", cache=self._name, result="miss")
+            return None
+        metrics.inc("cache_requests_total", cache=self._name, result="hit")
+        return entry["value"]
+
+    def lock(self, key: str):
+        """returns a lock on key across threads and processes, to be held while
+        fetching the value so concurrent misses fetch it once"""
+        return file_lock(f"{self._path(key)}.lock")
+
+    def set(self, key: str, value) -> None:
+        """stores value for key in memory and on disk"""
+        entry = {"expires": time.time() + self._ttl, "value": value}
+        self._memory[key] = entry
+        os.makedirs(self._dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, default=str)
+        os.replace(tmp_path, path)
+
+
+class ImageCache:
+    """rendered images in an in-memory LRU backed by a size-bounded disk tier,
+    safe to use from several threads"""
+
+    def __init__(self, name: str, max_items=256, max_bytes=512 * 1024 * 1024) -> None:
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._dir = os.path.join(CACHE_DIR, name)
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # guards the memory tier and the counters, the disk is accessed outside it
+        self._lock = threading.Lock()
+        os.makedirs(self._dir, exist_ok=True)
+        self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self._dir))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _remember(self, key: str, image: bytes) -> None:
+        # called with the lock held
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_items:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str):
+        """returns the cached image for key or None"""
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return image
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                image = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self._remember(key, image)
+            self.hits += 1
+        return image
+
+    def set(self, key: str, image: bytes) -> None:
+        """stores image for key, evicting the least recently used images"""
+        with self._lock:
+            self._remember(key, image)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(image)
+            over = self._disk_bytes > self._max_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        entries = sorted(os.scandir(self._dir), key=lambda entry: entry.stat().st_mtime)
+        disk_bytes = sum(entry.stat().st_size for entry in entries)
+        evictions = 0
+        for entry in entries:
+            if disk_bytes <= self._max_bytes:
+                break
+            disk_bytes -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            evictions += 1
+        with self._lock:
+            self._disk_bytes = disk_bytes
+            self.evictions += evictions
+
+    def stats(self) -> dict:
+        """returns the hit/miss/eviction counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -1,18 +1,214 @@
+import asyncio
+import functools
+import io
+import logging
+import os
+import time
 from discord.flags import Intents
 import discord
-import plot_lib as pl
+from admission import RenderScheduler
+from cache import ImageCache
+from live import LiveWatches
+import metrics
+from prerender import Prerenderer
+from render_pool import ChartRequest, RenderPool, image_extension, validate_request
+from render_service import RemoteRenderPool
+import scan
+
+# discord allows at most 10 attachments per message
+MAX_TICKERS = 10
+SCAN_USAGE = "Usage: !scan rvol>2 adr20>0.04 close>sma50 sort=rvol limit=25 charts=3"
+
+logger = logging.getLogger(__name__)
+_start_time = time.perf_counter()
+
+
+def _degraded_note(ticker: str, image: bytes):
+    """returns the note marking a chart rendered without some of its data, None if complete"""
+    missing = getattr(image, "missing", ())
+    if missing:
+        return f"{ticker.upper()}: no {' or '.join(missing)} in time, charted without"
+    return None
 
 
 class ChartBot(discord.Client):
     """ChartBot class"""
 
-    def __init__(self, token) -> None:
+    def __init__(
+        self,
+        token,
+        render_workers=None,
+        metrics_port=None,
+        watchlist=None,
+        render_endpoints=None,
+    ) -> None:
         _intents = Intents.default()
         _intents.message_content = True
         super().__init__(intents=_intents)
         self._token = token
+        self._chart_cache = ImageCache("charts")
+        render_workers = render_workers or os.cpu_count()
+        if render_endpoints:
+            # thin client: render_service nodes with render_workers each render the charts
+            self._render_pool = RemoteRenderPool(render_endpoints)
+            concurrency = render_workers * len(render_endpoints)
+        else:
+            self._render_pool = RenderPool(
+                max_workers=render_workers, cache=self._chart_cache
+            )
+            concurrency = render_workers
+        self._scheduler = RenderScheduler(self._render_pool, concurrency=concurrency)
+        self._live = LiveWatches(self._render_pool)
+        self._warm_up_task = None
+        self._prerenderer = None
+        if watchlist is not None and not render_endpoints:
+            self._prerenderer = Prerenderer(
+                watchlist, self._chart_cache, self._render_pool
+            )
+        metrics.register_collector(self._cache_metrics)
+        if metrics_port is not None:
+            metrics.start_http_server(metrics_port)
         super().run(self._token)
 
+    def _cache_metrics(self) -> list:
+        """rendered-chart cache gauges for the metrics endpoint"""
+        stats = self._chart_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        labels = {"cache": "charts"}
+        return [
+            ("image_cache_hit_ratio", labels, stats["hits"] / lookups if lookups else 0),
+            *((f"image_cache_{key}", labels, value) for key, value in stats.items()),
+        ]
+
+    async def on_ready(self) -> None:
+        """Ready event"""
+        logger.info("connected in %.2fs", time.perf_counter() - _start_time)
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+            if self._prerenderer is not None:
+                self._prerenderer.start()
+
+    async def _warm_up(self) -> None:
+        start = time.perf_counter()
+        try:
+            latencies = await self._render_pool.warm_up()
+        except Exception as e:
+            logger.warning("render pool warm-up failed: %s", e)
+            return
+        logger.info(
+            "%d render workers warm in %.2fs, first-chart latency %.2fs",
+            len(latencies),
+            time.perf_counter() - start,
+            max(latencies.values()),
+        )
+
+    async def close(self) -> None:
+        self._live.stop()
+        if self._prerenderer is not None:
+            self._prerenderer.stop()
+        self._render_pool.shutdown()
+        await super().close()
+
+    async def _render(self, message, requests: list) -> list:
+        """admits and queues the requests that are not cached, telling the user
+        when they have to wait, returns an image or exception per request"""
+        user = message.author.id
+        for request in requests:
+            validate_request(request)
+        images = await self._scheduler.admit_uncached(
+            requests, user, getattr(message.guild, "id", None)
+        )
+        uncached = [request for request, image in zip(requests, images) if image is None]
+        if len(uncached) > 1:
+            await self._render_pool.prefetch(
+                [request.ticker for request in uncached], uncached[0].interval
+            )
+        futures = [self._scheduler.enqueue(request, user) for request in uncached]
+        position = max((self._scheduler.position(future) for future in futures), default=0)
+        if position:
+            await message.channel.send(f"busy, position {position}")
+        rendered = iter(await asyncio.gather(*futures, return_exceptions=True))
+        return [next(rendered) if image is None else image for image in images]
+
+    async def _send_charts(self, message, requests: list, results: list) -> None:
+        """posts several rendered charts as one message"""
+        files = []
+        errors = []
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                errors.append(str(result))
+                continue
+            note = _degraded_note(request.ticker, result)
+            if note is not None:
+                errors.append(note)
+            files.append(
+                discord.File(
+                    io.BytesIO(result),
+                    filename=f"{request.ticker}.{image_extension(result)}",
+                )
+            )
+        with metrics.timed("upload"):
+            await message.channel.send(content="\n".join(errors) or None, files=files)
+
+    async def _watch(self, message, request: ChartRequest) -> None:
+        """posts a live chart of request and edits it until the close"""
+        validate_request(request)
+        self._scheduler.admit([request], message.author.id, getattr(message.guild, "id", None))
+        posted = None
+
+        def chart_file(image: bytes) -> discord.File:
+            return discord.File(io.BytesIO(image), filename=f"chart.{image_extension(image)}")
+
+        async def post(image: bytes) -> None:
+            nonlocal posted
+            posted = await message.channel.send(
+                content=f"{request.ticker.upper()} live", file=chart_file(image)
+            )
+
+        async def edit(image, closed: bool) -> None:
+            kwargs = {}
+            if image is not None:
+                kwargs["attachments"] = [chart_file(image)]
+            if closed:
+                kwargs["content"] = f"{request.ticker.upper()} at the close"
+            await posted.edit(**kwargs)
+
+        await self._live.start(request, post, edit)
+
+    async def _scan(self, message, args: list) -> None:
+        """scans the stored universe on the filters in args and posts the ranked
+        matches, with charts of the first ones for charts=N"""
+        if isinstance(self._render_pool, RemoteRenderPool):
+            # the bars are stored on the render service nodes, this bar store is empty
+            raise Exception("Scans are not available with remote renderers")
+        filters = []
+        options = {}
+        for arg in filter(None, args):
+            key, _, value = arg.partition("=")
+            if key == "sort":
+                options[key] = value
+            elif key in ("limit", "charts"):
+                if not value.isdecimal():
+                    raise Exception(f"{SCAN_USAGE}, {key} takes a number")
+                options[key] = int(value)
+            else:
+                filters.append(arg)
+        charts = min(options.get("charts", 0), MAX_TICKERS)
+        with metrics.timed("scan"):
+            result = await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    scan.scan,
+                    filters,
+                    options.get("sort", scan.DEFAULT_SORT),
+                    limit=min(options.get("limit", scan.SCAN_LIMIT), scan.SCAN_LIMIT),
+                ),
+            )
+        await message.channel.send(f"```\n{scan.format_result(result)}\n```")
+        requests = [ChartRequest(match["ticker"]) for match in result["matches"][:charts]]
+        if requests:
+            await self._send_charts(message, requests, await self._render(message, requests))
+
     async def on_message(self, message):
         """Message event"""
         if message.author == self.user:
@@ -22,25 +218,84 @@ class ChartBot(discord.Client):
         try:
             action = split_msg[0]
             if action in ("!chart", "!wchart"):
-                ticker = split_msg[1]
+                live = "live" in split_msg[1:]
+                tickers = [
+                    arg for arg in split_msg[1:] if arg and "=" not in arg and arg != "live"
+                ]
                 kwargs = {}
                 if len(split_msg) > 2:
                     for arg in split_msg[1:]:
                         if "=" in arg:
                             key, value = arg.split("=")
                             kwargs[key] = int(value) if value.isdecimal() else value
-                pl.create_chart_image(
-                    ticker,
-                    "!wchart" in action,
-                    kwargs.get("style", "qullamaggie"),
-                    kwargs.get("offset", 9 if action == "!chart" else 40),
+                requests = [
+                    ChartRequest(
+                        ticker,
+                        "!wchart" in action,
+                        kwargs.get("style", "qullamaggie"),
+                        kwargs.get("offset", 9 if action == "!chart" else 40),
+                        kwargs.get("format"),
+                        kwargs.get("dpi"),
+                        kwargs.get("engine"),
+                    )
+                    for ticker in dict.fromkeys(tickers)
+                ]
+                if len(requests) > MAX_TICKERS:
+                    raise Exception(f"At most {MAX_TICKERS} tickers per message")
+                if live:
+                    if len(requests) != 1:
+                        raise Exception("Live charts take one ticker")
+                    await self._watch(message, requests[0])
+                    return
+                with metrics.timed("message"):
+                    results = await self._render(message, requests)
+                    if len(requests) > 1:
+                        await self._send_charts(message, requests, results)
+                        return
+                    image = results[0]
+                    if isinstance(image, Exception):
+                        raise image
+                    with metrics.timed("upload"):
+                        await message.channel.send(
+                            content=_degraded_note(requests[0].ticker, image),
+                            file=discord.File(
+                                io.BytesIO(image),
+                                filename=f"chart.{image_extension(image)}",
+                            )
+                        )
+            elif action == "!scan":
+                await self._scan(message, split_msg[1:])
+            elif action == "!cachestats":
+                stats = self._chart_cache.stats()
+                await message.channel.send(
+                    ", ".join(f"{key}: {value}" for key, value in stats.items())
                 )
-                await message.channel.send(file=discord.File("img.png"))
 
         except Exception as e:
             await message.channel.send(str(e))
 
 
+class ShardedChartBot(ChartBot, discord.AutoShardedClient):
+    """ChartBot on several gateway shards in one process, for large bots"""
+
+
 if __name__ == "__main__":
     YOUR_DISCORD_TOKEN = "TOKEN_FROM_DISCORD_WEBSITE"
-    chart_bot = ChartBot(YOUR_DISCORD_TOKEN)
+    RENDER_WORKERS = os.cpu_count()
+    # serves prometheus text metrics on http://127.0.0.1:<port>/metrics, None disables
+    METRICS_PORT = 9108
+    # tickers pre-rendered after the close and before the open, one per line, None disables
+    WATCHLIST = None
+    # render_service.py nodes to send renders to instead of rendering in this
+    # process, e.g. ["http://127.0.0.1:8081", "http://127.0.0.1:8082"]. RENDER_WORKERS
+    # is then the number of workers per node and WATCHLIST is set on the nodes
+    RENDER_ENDPOINTS = None
+    SHARDED = False
+    bot_class = ShardedChartBot if SHARDED else ChartBot
+    chart_bot = bot_class(
+        YOUR_DISCORD_TOKEN,
+        render_workers=RENDER_WORKERS,
+        metrics_port=METRICS_PORT,
+        watchlist=WATCHLIST,
+        render_endpoints=RENDER_ENDPOINTS,
+    )
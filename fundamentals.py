@@ -0,0 +1,162 @@
+"""Module providing bulk finviz fundamentals
+
+Fills the finviz fundamentals store for many tickers from screener pages, 20
+tickers a page, or from one screener export when FINVIZ_AUTH holds a finviz
+elite token, instead of one quote page per ticker."""
+
+import csv
+import io
+import os
+from bs4 import BeautifulSoup, SoupStrainer
+import metrics
+from scraper import failures_cache, format_float, format_pct, fundamentals_cache, http_get
+from scraper import scrape_finviz
+
+SCREENER_URL = "https://finviz.com/screener.ashx"
+EXPORT_URL = "https://elite.finviz.com/export.ashx"
+# custom view columns: ticker, P/E, forward P/E, PEG, P/S, P/B, P/FCF, float,
+# insider own, inst own, inst trans, short float, ROA, ROE, ROI, gross, operating
+# and profit margin. Columns are matched by their header, not their position
+SCREENER_COLUMNS = "1,7,8,9,10,11,13,25,26,28,29,30,32,33,34,39,40,41"
+PAGE_SIZE = 20
+TICKERS_PER_QUERY = 100
+FINVIZ_AUTH = os.environ.get("FINVIZ_AUTH")
+
+
+def _format_millions(value: str):
+    """parses 1.2K/M/B/T abbreviated or plain (already in millions) share counts to millions"""
+    scale = {"K": 1e-3, "M": 1, "B": 1e3, "T": 1e6}
+    try:
+        if value[-1:] in scale:
+            return float(value[:-1]) * scale[value[-1]]
+        return float(value)
+    except ValueError:
+        return 0
+
+
+# result field: (formatter, screener and export headers)
+FIELDS = {
+    "pe": (format_float, ("P/E",)),
+    "forward_pe": (format_float, ("Fwd P/E", "Forward P/E")),
+    "peg": (format_float, ("PEG",)),
+    "ps": (format_float, ("P/S",)),
+    "pb": (format_float, ("P/B",)),
+    "pfcf": (format_float, ("P/FCF", "P/Free Cash Flow")),
+    "shares_float": (_format_millions, ("Float", "Shares Float")),
+    "insider_own": (format_pct, ("Insider Own", "Insider Ownership")),
+    "inst_own": (format_pct, ("Inst Own", "Institutional Ownership")),
+    "inst_trans": (format_pct, ("Inst Trans", "Institutional Transactions")),
+    "short_float": (format_pct, ("Short Float", "Float Short")),
+    "roa": (format_pct, ("ROA", "Return on Assets")),
+    "roe": (format_pct, ("ROE", "Return on Equity")),
+    "roi": (format_pct, ("ROI", "ROIC", "Return on Investment")),
+    "gross_margin": (format_pct, ("Gross M", "Gross Margin")),
+    "oper_margin": (format_pct, ("Oper M", "Operating Margin")),
+    "profit_margin": (format_pct, ("Profit M", "Profit Margin")),
+    "eps_surprise": (format_pct, ("EPS Surprise",)),
+    "sales_surprise": (format_pct, ("Sales Surprise", "Revenue Surprise")),
+}
+_HEADERS = {header: field for field, (_, headers) in FIELDS.items() for header in headers}
+
+
+def _to_result(row: dict) -> dict:
+    """maps a screener row of header: text to the fields parse_finviz returns"""
+    values = {_HEADERS[header]: value for header, value in row.items() if header in _HEADERS}
+    result = {"ticker": row["Ticker"].lower()}
+    for field, (formatter, _) in FIELDS.items():
+        result[field] = formatter(values.get(field, "").strip())
+    return result
+
+
+def parse_screener(content: bytes) -> dict:
+    """parses a finviz screener page, returns the fundamentals keyed by lower-case ticker"""
+    strainer = SoupStrainer("table")
+    results = {}
+    for table in BeautifulSoup(content, "html.parser", parse_only=strainer).find_all(
+        "table"
+    ):
+        rows = table.find_all("tr")
+        if not rows:
+            continue
+        header = [cell.text.strip() for cell in rows[0].find_all(["th", "td"])]
+        if "Ticker" not in header:
+            continue
+        for row in rows[1:]:
+            cells = [cell.text.strip() for cell in row.find_all("td")]
+            if len(cells) == len(header):
+                result = _to_result(dict(zip(header, cells)))
+                results[result["ticker"]] = result
+    return results
+
+
+def parse_export(content: bytes) -> dict:
+    """parses a finviz screener csv export, returns the fundamentals keyed by lower-case ticker"""
+    reader = csv.DictReader(io.StringIO(content.decode("utf-8-sig")))
+    return {row["Ticker"].lower(): _to_result(row) for row in reader if row.get("Ticker")}
+
+
+def _fetch(tickers: list) -> dict:
+    """fetches the fundamentals of at most TICKERS_PER_QUERY tickers, None when
+    finviz did not answer"""
+    query = ",".join(ticker.upper() for ticker in tickers)
+    if FINVIZ_AUTH:
+        response = http_get(
+            f"{EXPORT_URL}?v=152&t={query}&c={SCREENER_COLUMNS}&auth={FINVIZ_AUTH}"
+        )
+        if response is None:
+            return None
+        return parse_export(response.content) if response.status_code == 200 else {}
+    results = {}
+    for row in range(1, len(tickers) + 1, PAGE_SIZE):
+        response = http_get(f"{SCREENER_URL}?v=152&t={query}&c={SCREENER_COLUMNS}&r={row}")
+        if response is None:
+            return None
+        if response.status_code == 200:
+            results.update(parse_screener(response.content))
+    return results
+
+
+def fetch_fundamentals(tickers) -> dict:
+    """fills the fundamentals store with the tickers missing from it, returns
+    the fundamentals of tickers keyed by lower-case ticker"""
+    results = {}
+    missing = []
+    for key in dict.fromkeys(ticker.lower() for ticker in tickers):
+        result = fundamentals_cache.get(key)
+        if result is not None:
+            results[key] = result
+        elif failures_cache.get(key) is None:
+            missing.append(key)
+    for i in range(0, len(missing), TICKERS_PER_QUERY):
+        chunk = missing[i : i + TICKERS_PER_QUERY]
+        with metrics.timed("fundamentals_fetch"):
+            fetched = _fetch(chunk)
+        if fetched is None:
+            metrics.inc("upstream_failures_total", upstream="finviz_screener")
+            for key in chunk:
+                failures_cache.set(key, True)
+            continue
+        for key in chunk:
+            if key in fetched:
+                fundamentals_cache.set(key, fetched[key])
+                results[key] = fetched[key]
+    return results
+
+
+def get_fundamentals(ticker: str) -> dict:
+    """returns the fundamentals of ticker from the store, fetching them on a
+    miss, empty if finviz did not answer in time"""
+    key = ticker.lower()
+    result = fundamentals_cache.get(key)
+    if result is not None:
+        return result
+    with fundamentals_cache.lock(key):
+        result = fundamentals_cache.get(key)
+        if result is not None:
+            metrics.inc("coalesced_total", flight="finviz")
+            return result
+        result = fetch_fundamentals([key]).get(key)
+    if result is None:
+        # not on the screener, the quote page tells whether ticker exists
+        result = scrape_finviz(ticker)
+    return result
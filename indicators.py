@@ -0,0 +1,190 @@
+"""Module providing the technical indicator registry"""
+
+import math
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# an ema never fully forgets its seed, after this many spans the seed's
+# weight is below 0.1% which is invisible on a chart
+EMA_WARMUP_SPANS = 4
+
+
+class _RollingMean:
+    """mean of the last window values, O(1) per bar"""
+
+    def __init__(self, value, window: int) -> None:
+        self._value = value
+        self._window = window
+
+    def seed(self, df: pd.DataFrame) -> None:
+        self._values = deque(self._value(df).to_numpy(dtype=float)[-self._window :])
+        self._sum = sum(self._values)
+
+    def update(self, bar, new: bool) -> float:
+        value = float(self._value(bar))
+        if new:
+            self._values.append(value)
+            self._sum += value
+            if len(self._values) > self._window:
+                self._sum -= self._values.popleft()
+        else:
+            self._sum += value - self._values[-1]
+            self._values[-1] = value
+        if not math.isfinite(self._sum):
+            # a nan left the window, the running sum cannot recover by itself
+            self._sum = sum(self._values)
+        return self._sum / self._window if len(self._values) == self._window else math.nan
+
+
+class _Ema:
+    """exponential moving average, O(1) per bar"""
+
+    def __init__(self, value, span: int) -> None:
+        self._value = value
+        self._alpha = 2 / (span + 1)
+        self._span = span
+
+    def seed(self, df: pd.DataFrame) -> None:
+        ema = self._value(df).ewm(span=self._span, adjust=False).mean().to_numpy()
+        # the ema before the last bar, which a revision of the last bar starts from
+        self._previous = ema[-2] if len(ema) > 1 else math.nan
+        self._last = ema[-1] if len(ema) else math.nan
+
+    def update(self, bar, new: bool) -> float:
+        if new:
+            self._previous = self._last
+        value = float(self._value(bar))
+        if math.isnan(self._previous):
+            self._last = value
+        else:
+            self._last = self._previous + self._alpha * (value - self._previous)
+        return self._last
+
+
+class _Ratio:
+    """value relative to the rolling mean of the last window values"""
+
+    def __init__(self, value, window: int) -> None:
+        self._value = value
+        self._mean = _RollingMean(value, window)
+
+    def seed(self, df: pd.DataFrame) -> None:
+        self._mean.seed(df)
+
+    def update(self, bar, new: bool) -> float:
+        return float(self._value(bar)) / self._mean.update(bar, new)
+
+
+def _last_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """mean of the last window columns of every row, nan where one is missing"""
+    if values.shape[1] < window:
+        return np.full(len(values), np.nan)
+    return values[:, -window:].mean(axis=1)
+
+
+def _last_ema(values: np.ndarray, span: int) -> np.ndarray:
+    """ema of every row at its last column, seeded with the row's first value
+    like ewm(adjust=False), one vectorized step per column"""
+    alpha = 2 / (span + 1)
+    ema = np.full(len(values), np.nan)
+    for column in values.T:
+        step = ema + alpha * (column - ema)
+        ema = np.where(np.isnan(ema), column, np.where(np.isnan(column), ema, step))
+    return ema
+
+
+def _sma(column: str, window: int):
+    return (
+        lambda df: df[column].rolling(window).mean(),
+        window - 1,
+        lambda: _RollingMean(lambda bars: bars[column], window),
+        lambda bars: _last_mean(bars[column], window),
+    )
+
+
+def _ema(column: str, span: int):
+    return (
+        lambda df: df[column].ewm(span=span, adjust=False).mean(),
+        EMA_WARMUP_SPANS * span,
+        lambda: _Ema(lambda bars: bars[column], span),
+        lambda bars: _last_ema(bars[column], span),
+    )
+
+
+def _adr(span: int):
+    return (
+        lambda df: (df["high"] / df["low"] - 1).ewm(span=span, adjust=False).mean(),
+        EMA_WARMUP_SPANS * span,
+        lambda: _Ema(lambda bars: bars["high"] / bars["low"] - 1, span),
+        lambda bars: _last_ema(bars["high"] / bars["low"] - 1, span),
+    )
+
+
+def _rvol(window: int):
+    return (
+        lambda df: df["volume"] / df["volume"].rolling(window).mean(),
+        window - 1,
+        lambda: _Ratio(lambda bars: bars["volume"], window),
+        lambda bars: bars["volume"][:, -1] / _last_mean(bars["volume"], window),
+    )
+
+
+# name -> (function computing the series from an ohlcv frame, warm-up bars,
+# factory of its incremental state, function computing the value at the last
+# bar of every row of 2D ohlcv arrays)
+INDICATORS = {
+    "sma10": _sma("close", 10),
+    "sma20": _sma("close", 20),
+    "sma30": _sma("close", 30),
+    "sma50": _sma("close", 50),
+    "ema9": _ema("close", 9),
+    "ema21": _ema("close", 21),
+    "ema65": _ema("close", 65),
+    "adr20": _adr(20),
+    "volume_sma10": _sma("volume", 10),
+    "volume_sma50": _sma("volume", 50),
+    "rvol": _rvol(50),
+}
+
+
+def _lookup(name: str):
+    if name not in INDICATORS:
+        raise Exception(f"Unknown indicator: {name}")
+    return INDICATORS[name]
+
+
+def warmup(names) -> int:
+    """returns the number of bars needed before the first visible bar"""
+    return max((_lookup(name)[1] for name in names), default=0)
+
+
+def add_indicators(df: pd.DataFrame, names) -> pd.DataFrame:
+    """adds the named indicator columns to df"""
+    for name in names:
+        df[name] = _lookup(name)[0](df)
+    return df
+
+
+class LiveIndicators:
+    """the named indicators of the latest bar, updated in O(1) per bar from
+    rolling state instead of recomputed over the whole frame"""
+
+    def __init__(self, df: pd.DataFrame, names) -> None:
+        """seeds the rolling state from the ohlcv bars of df, at least the
+        warm-up bars of names"""
+        self._states = {name: _lookup(name)[2]() for name in names}
+        for state in self._states.values():
+            state.seed(df)
+
+    def update(self, bar, new: bool) -> dict:
+        """takes the latest ohlcv bar, new if it follows the last seen bar,
+        otherwise it revises it, returns the indicator values of the bar"""
+        return {name: state.update(bar, new) for name, state in self._states.items()}
+
+
+def latest_indicators(bars, names) -> dict:
+    """returns the named indicators at the last bar of every row of bars, 2D
+    ohlcv arrays with one row per ticker, in one vectorized pass over all rows.
+    Rows need the warm-up bars of names before their last bar"""
+    return {name: _lookup(name)[3](bars) for name in names}
@@ -0,0 +1,149 @@
+"""Module providing live charts that update during the session"""
+
+import asyncio
+import importlib
+import logging
+
+import metrics
+from render_pool import ChartRequest
+
+# seconds between updates of a live chart, the bar store refreshes at most this often
+LIVE_INTERVAL = 60
+MAX_WATCHES = 5
+
+logger = logging.getLogger(__name__)
+
+
+class LiveChart:
+    """the visible bars, rolling indicator state, meta and fundamentals of a
+    live chart. The full pipeline runs once, updates only apply the newest bars"""
+
+    def __init__(self, request: ChartRequest) -> None:
+        self.request = request
+        self.stock_data = None
+        self.fundamentals = None
+        self._indicators = None
+
+    def load(self) -> None:
+        """gathers the chart data and seeds the indicator state"""
+        import bar_store
+        import indicators as ind
+        import plot_lib as pl
+        import utils as ut
+        from fundamentals import get_fundamentals
+
+        request = self.request
+        config = pl.chart_config(request.style, request.weekly)
+        names = pl.get_required_indicators(config)
+        self.stock_data = ut.get_stock_data(
+            request.ticker, weekly=request.weekly, offset=request.offset, indicators=names
+        ).copy()
+        self.fundamentals = get_fundamentals(request.ticker)
+        history = bar_store.get_bars(request.ticker, request.interval)
+        # the rolling state ends at the last bar shown
+        history = history[history.index <= self.stock_data.index[-1]]
+        self._indicators = ind.LiveIndicators(history, names)
+
+    def refresh(self) -> bool:
+        """applies the bars newer than or revising the last shown bar, O(1)
+        per bar, returns whether the chart changed"""
+        import pandas as pd
+        import bar_store
+
+        # only the newest bars are read, the bar store fetches only newer bars
+        latest = bar_store.last_bars(self.request.ticker, 2, self.request.interval)
+        df = self.stock_data
+        ohlcv = list(bar_store.AGGREGATION)
+        changed = False
+        for date, bar in latest[latest.index >= df.index[-1]].iterrows():
+            new = date > df.index[-1]
+            if not new and (df.loc[date, ohlcv].to_numpy() == bar.to_numpy()).all():
+                continue
+            values = self._indicators.update(bar, new)
+            if new:
+                # the window slides by one bar, the meta columns carry over
+                row = df.iloc[[-1]].copy()
+                row.index = pd.DatetimeIndex([date], name=df.index.name)
+                df = pd.concat([df.iloc[1:], row])
+            df.loc[date, ohlcv] = bar[ohlcv].to_numpy()
+            df.loc[date, list(values)] = list(values.values())
+            changed = True
+        self.stock_data = df
+        return changed
+
+
+class LiveWatches:
+    """live charts being watched, at most max_watches at a time, each re-rendered
+    every interval seconds while its data changes until the close"""
+
+    def __init__(self, pool, max_watches=MAX_WATCHES, interval=LIVE_INTERVAL) -> None:
+        self._pool = pool
+        self._max_watches = max_watches
+        self._interval = interval
+        self._tasks = set()
+        self._loading = 0
+
+    def __len__(self) -> int:
+        return len(self._tasks) + self._loading
+
+    async def start(self, request: ChartRequest, post, edit) -> None:
+        """posts the chart of request with await post(image) and starts editing
+        it with await edit(image, closed) until the close, image is None when
+        only closed changed. Raises when the cap is reached or the market is
+        closed"""
+        if not hasattr(self._pool, "render_frame"):
+            raise Exception("Live charts are not available with remote renderers")
+        if len(self) >= self._max_watches:
+            metrics.inc("shed_total", reason="live_watches")
+            raise Exception(
+                f"At most {self._max_watches} live charts at once, try again later"
+            )
+        loop = asyncio.get_running_loop()
+        bar_store = await loop.run_in_executor(None, importlib.import_module, "bar_store")
+        if not bar_store.market_is_open():
+            raise Exception("Live charts run during market hours")
+        chart = LiveChart(request)
+        # counted while loading so concurrent starts respect the cap
+        self._loading += 1
+        try:
+            await loop.run_in_executor(None, chart.load)
+            await post(await self._render(chart))
+        finally:
+            self._loading -= 1
+        watch = asyncio.create_task(self._watch(chart, edit))
+        self._tasks.add(watch)
+        metrics.add("live_watches", 1)
+        watch.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        metrics.add("live_watches", -1)
+
+    async def _render(self, chart: LiveChart) -> bytes:
+        return await self._pool.render_frame(
+            chart.request, chart.stock_data, chart.fundamentals
+        )
+
+    async def _watch(self, chart: LiveChart, edit) -> None:
+        import bar_store
+
+        loop = asyncio.get_running_loop()
+        closed = False
+        while not closed:
+            await asyncio.sleep(self._interval)
+            # one last update with the closing bar, then the watch ends
+            closed = not bar_store.market_is_open()
+            image = None
+            try:
+                with metrics.timed("live_update"):
+                    if await loop.run_in_executor(None, chart.refresh):
+                        image = await self._render(chart)
+                if image is not None or closed:
+                    await edit(image, closed)
+            except Exception as e:
+                logger.warning("live update of %s failed: %s", chart.request.ticker, e)
+
+    def stop(self) -> None:
+        """stops every watch"""
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,194 @@
+"""Module providing latency instrumentation and a prometheus-style metrics endpoint"""
+
+import bisect
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "chartbot_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+# log every observation as a json line
+STRUCTURED_LOGS = False
+# fraction of profiled() blocks run under cProfile, their stats are kept when
+# they take longer than PROFILE_SLOW_SECONDS
+PROFILE_RATE = 0.0
+PROFILE_SLOW_SECONDS = 5.0
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_collectors = []
+# worker processes buffer their observations to ship them to the bot process
+_buffer = None
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return PREFIX + name, tuple(sorted(labels.items()))
+
+
+def _record(kind: str, name: str, value: float, labels: dict) -> None:
+    if _buffer is not None:
+        _buffer.append((kind, name, value, labels))
+        return
+    key = _key(name, labels)
+    with _lock:
+        if kind == "counter":
+            _counters[key] = _counters.get(key, 0) + value
+        elif kind == "gauge":
+            _gauges[key] = _gauges.get(key, 0) + value
+        else:
+            histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            index = bisect.bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    if STRUCTURED_LOGS:
+        logger.info(json.dumps({"metric": name, "type": kind, "value": value, **labels}))
+
+
+def inc(name: str, value=1, **labels) -> None:
+    """increments a counter"""
+    _record("counter", name, value, labels)
+
+
+def add(name: str, value: float, **labels) -> None:
+    """adds value to a gauge"""
+    _record("gauge", name, value, labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """records value in a histogram"""
+    _record("histogram", name, value, labels)
+
+
+@contextmanager
+def timed(stage: str):
+    """records the latency, in-flight count and errors of a pipeline stage"""
+    add("stage_in_flight", 1, stage=stage)
+    start = time.perf_counter()
+    try:
+        yield
+    except:
+        inc("stage_errors_total", stage=stage)
+        raise
+    finally:
+        add("stage_in_flight", -1, stage=stage)
+        observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+@contextmanager
+def profiled(name: str):
+    """runs a sampled fraction of blocks under cProfile and dumps the stats
+    of slow ones to PROFILES_DIR"""
+    if PROFILE_RATE <= 0 or random.random() >= PROFILE_RATE:
+        yield
+        return
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        if elapsed >= PROFILE_SLOW_SECONDS:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            path = os.path.join(PROFILES_DIR, f"{name}-{int(time.time() * 1000)}.prof")
+            profiler.dump_stats(path)
+            logger.info("%s took %.2fs, profile written to %s", name, elapsed, path)
+
+
+def start_buffer() -> None:
+    """buffers the observations of this process until drain()"""
+    global _buffer
+    _buffer = []
+
+
+def drain() -> list:
+    """returns and clears the buffered observations"""
+    events = list(_buffer or ())
+    if _buffer is not None:
+        _buffer.clear()
+    return events
+
+
+def merge(events) -> None:
+    """records observations drained in another process"""
+    for kind, name, value, labels in events:
+        _record(kind, name, value, labels)
+
+
+def register_collector(collect) -> None:
+    """registers a callable returning (name, labels, value) gauges computed at scrape time"""
+    _collectors.append(collect)
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    """returns all metrics in the prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for kind, values in (("counter", _counters), ("gauge", _gauges)):
+            for name in sorted({key[0] for key in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (key_name, labels), value in sorted(values.items()):
+                    if key_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({key[0] for key in _histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (key_name, labels), (counts, total, count) in sorted(_histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bucket, bucket_count in zip(BUCKETS, counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(labels + (("le", bucket),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                inf_labels = _format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{inf_labels} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for collect in _collectors:
+        for name, labels, value in collect():
+            labels = tuple(sorted(labels.items()))
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host="127.0.0.1") -> ThreadingHTTPServer:
+    """serves /metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,13 +1,59 @@
 """Module providing chart-plotting functions"""
 
+import colorsys
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from types import MappingProxyType
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import mplfinance as mpf
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import matplotlib.ticker as mticker
+from matplotlib.collections import LineCollection, PolyCollection
+from PIL import Image
 from zigzag.core import peak_valley_pivots
 import utils as ut
-from scraper import scrape_finviz
+import metrics
+from fundamentals import get_fundamentals
+from render_pool import IMAGE_FORMATS, check_dpi
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+logger = logging.getLogger(__name__)
+
+STYLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles")
+# reuse laid-out figures between renders instead of building them from scratch
+FIGURE_TEMPLATES = True
+MAX_TEMPLATES_PER_STYLE = 2
+# "mpf" plots the bars with mplfinance, "fast" draws the same bars directly as
+# batched matplotlib collections, a style or request can pick either
+RENDER_ENGINES = ("mpf", "fast")
+DEFAULT_ENGINE = "mpf"
+# mplfinance's width table: bar and line widths by number of bars, interpolated
+# in between and clamped outside, with mplfinance's defaults for our charts
+_WIDTH_BARS = (30, 60, 90, 120, 150, 180, 210, 240)
+_WIDTHS = {
+    "volume": (0.98, 0.96, 0.95, 0.925, 0.9, 0.9, 0.875, 0.825),
+    "volume_line": (0.65,) * 8,
+    "candle": (0.65, 0.575, 0.50, 0.445, 0.435, 0.425, 0.420, 0.415),
+    "candle_line": (1.00, 0.875, 0.75, 0.625, 0.500, 0.438, 0.435, 0.435),
+}
+VOLUME_WIDTH_SCALE = 0.7
+# seconds the name/sector meta and the fundamentals may take, counted from the
+# start of the render: a chart renders without what misses it, price data is waited for
+GATHER_DEADLINE = 3.0
+GATHER_THREADS = 4
+OHLC_TICKSIZE = 0.5
+OHLC_LINEWIDTH = 1.5
 
 
 def get_ibd_config() -> dict:
@@ -56,6 +102,8 @@ def get_ibd_config() -> dict:
         "plot_type": "ohlc",
         "finviz": "#000000",
         "font": "Arial",
+        "image_format": "png8",
+        "dpi": 100,
     }
 
 
@@ -105,6 +153,8 @@ def get_qullamaggie_config() -> dict:
         "plot_type": "candle",
         "finviz": "#ffffff",
         "font": "DejaVu Sans",
+        "image_format": "png8",
+        "dpi": 100,
     }
 
 
@@ -154,6 +204,8 @@ def get_light_config() -> dict:
         "plot_type": "candle",
         "finviz": "#000000",
         "font": "Arial",
+        "image_format": "png8",
+        "dpi": 100,
     }
 
 
@@ -195,20 +247,151 @@ def get_stockbee_config() -> dict:
         "plot_type": "candle",
         "finviz": "#000000",
         "font": "Arial",
+        "image_format": "png8",
+        "dpi": 100,
     }
 
 
-def _create_chart_with_config(
-    df: pd.DataFrame, config: dict, img_path: str = "img.png"
-):
-    thres = 0.1
-    df["max"] = df.high[peak_valley_pivots(np.array(df.high), thres, -thres) == 1]
-    df["min"] = df.low[peak_valley_pivots(np.array(df.low), thres, -thres) == -1]
+BUILTIN_STYLES = {
+    "qullamaggie": get_qullamaggie_config,
+    "ibd": get_ibd_config,
+    "light": get_light_config,
+    "stockbee": get_stockbee_config,
+}
+DEFAULT_STYLE = "qullamaggie"
 
-    egrid = (21, 29)
-    fig = mpf.figure(style=config["mpl_cfg"], figsize=(16, 9))
-    price_ax = plt.subplot2grid(egrid, (0, 0), colspan=29, rowspan=17)
-    volume_ax = plt.subplot2grid(egrid, (17, 0), colspan=29, rowspan=4, sharex=price_ax)
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+def _merge(base: dict, update: dict) -> dict:
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def load_style_file(path: str) -> dict:
+    """loads a style config from a json or toml file, a config with an
+    "extends" key is merged over that built-in style"""
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            if tomllib is None:
+                raise Exception(f"TOML styles need python 3.11+: {path}")
+            config = tomllib.load(f)
+        else:
+            config = json.load(f)
+    base = config.pop("extends", None)
+    if base is not None:
+        if base not in BUILTIN_STYLES:
+            raise Exception(
+                f"Unknown base style {base!r} in {path}, "
+                f"built-in styles are {sorted(BUILTIN_STYLES)}"
+            )
+        config = _merge(BUILTIN_STYLES[base](), config)
+    return config
+
+
+def _compile_styles(styles_dir: str) -> tuple:
+    """returns the immutable style registry and the mplfinance style of each
+    style, style files that fail to load are logged and skipped"""
+    styles = {}
+    mpf_styles = {}
+
+    def add(name, config):
+        config["name"] = name
+        style = _freeze(config)
+        mpf_styles[name] = _thaw(style["mpl_cfg"])
+        styles[name] = style
+
+    for name, get_config in BUILTIN_STYLES.items():
+        add(name, get_config())
+    if os.path.isdir(styles_dir):
+        for file_name in sorted(os.listdir(styles_dir)):
+            name, ext = os.path.splitext(file_name)
+            if ext not in (".json", ".toml"):
+                continue
+            path = os.path.join(styles_dir, file_name)
+            try:
+                add(name.lower(), load_style_file(path))
+            except Exception as e:
+                logger.warning("skipping style %s: %r", path, e)
+    return MappingProxyType(styles), mpf_styles
+
+
+def get_style(name: str) -> dict:
+    """returns a mutable copy of the named style, the default style if unknown"""
+    return dict(STYLES.get(name.lower(), STYLES[DEFAULT_STYLE]))
+
+
+def _get_addplots(config: dict) -> tuple:
+    """returns the (price, volume) addplots of config for its timeframe"""
+    prefix = "weekly_" if config.get("weekly", False) else ""
+    return (
+        config.get(f"{prefix}price_addplots", []),
+        config.get(f"{prefix}volume_addplots", []),
+    )
+
+
+def get_required_indicators(config: dict) -> set:
+    """returns the indicator columns needed to plot config"""
+    price_addplots, volume_addplots = _get_addplots(config)
+    return {ap[0] for ap in (*price_addplots, *volume_addplots)} | {"rvol"}
+
+
+def _get_rvol_peaks(rvol: np.ndarray, window=10, threshold=1.5) -> np.ndarray:
+    """returns the indices of bars with rvol above threshold that are the max
+    rvol of the bars [i - window, i + window)"""
+    if len(rvol) <= window:
+        return np.empty(0, dtype=int)
+    values = np.where(np.isnan(rvol), -np.inf, rvol)
+    padded = np.concatenate([values, np.full(window - 1, -np.inf)])
+    window_max = sliding_window_view(padded, 2 * window).max(axis=1)
+    candidates = values[window:]
+    peaks = (candidates > threshold) & (window_max <= candidates)
+    return np.flatnonzero(peaks) + window
+
+
+def _encode_figure(fig, image_format="png", dpi=None) -> bytes:
+    """encodes fig as png, palette-quantized png (png8) or lossless webp in memory"""
+    if image_format not in IMAGE_FORMATS:
+        raise Exception(f"Unknown image format: {image_format}")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi or "figure", bbox_inches="tight")
+    if image_format == "png":
+        return buf.getvalue()
+    buf.seek(0)
+    image = Image.open(buf).convert("RGB")
+    out = io.BytesIO()
+    if image_format == "png8":
+        image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        image.save(out, format="PNG", optimize=True)
+    else:
+        image.save(out, format="WEBP", lossless=True, method=4)
+    return out.getvalue()
+
+
+STYLES, _MPF_STYLES = _compile_styles(STYLES_DIR)
+# figure templates of this process, per style
+_templates = {}
+
+
+def _set_tick_params(price_ax, volume_ax) -> None:
     volume_ax.tick_params(
         which="both",
         labelbottom=True,
@@ -229,55 +412,77 @@ def _create_chart_with_config(
         top=False,
         right=False,
     )
-    kwargs = {
-        "horizontalalignment": "center",
-        "color": config["foreground"],
-        "fontsize": 8,
-        "backgroundcolor": config["background"],
-        "bbox": {
-            "boxstyle": "square",
-            "fc": config["background"],
-            "ec": "none",
-            "pad": 0,
-            "alpha": 0,
-        },
-    }
-    window_volume = 10
-    for i in range(window_volume, len(df)):
-        df_slice = df[i - window_volume : i + window_volume].copy()
-        if df["rvol"].iloc[i] > 1.5 and df_slice["rvol"].max() <= df["rvol"].iloc[i]:
-            volume_ax.text(
-                i + 1,
-                df["volume"].iloc[i] * 1.1,
-                str(int(df["rvol"].iloc[i] * 100))
-                + "%\n"
-                + str(np.round(df["volume"].iloc[i] / 1e6, 1))
-                + "M",
-                **kwargs,
-                verticalalignment="bottom",
-            )
 
-    stock_name = df["ticker"].values[-1]
-    finviz = scrape_finviz(stock_name)
-    addplots = []
-    if not config.get("weekly", False):
-        for ap in config.get("price_addplots", []):
-            addplots.append(
-                mpf.make_addplot(df[ap[0]], ax=price_ax, color=ap[1], width=ap[2])
-            )
-        for ap in config.get("volume_addplots", []):
-            addplots.append(
-                mpf.make_addplot(df[ap[0]], ax=volume_ax, color=ap[1], width=ap[2])
-            )
+
+def _new_template(config: dict) -> tuple:
+    """lays out a chart figure for config and snapshots the rc params of its style"""
+    egrid = (21, 29)
+    style = _MPF_STYLES.get(config.get("name")) or config["mpl_cfg"]
+    fig = mpf.figure(style=style, figsize=(16, 9))
+    price_ax = plt.subplot2grid(egrid, (0, 0), colspan=29, rowspan=17)
+    volume_ax = plt.subplot2grid(egrid, (17, 0), colspan=29, rowspan=4, sharex=price_ax)
+    return fig, price_ax, volume_ax, plt.rcParams.copy()
+
+
+def _clear_axes(ax) -> None:
+    """removes the artists of the previous chart, much cheaper than ax.cla()"""
+    for artist in [*ax.collections, *ax.lines, *ax.texts, *ax.patches]:
+        artist.remove()
+    ax.set_yscale("linear")
+    ax.relim()
+    ax.set_autoscale_on(True)
+
+
+def _acquire_template(config: dict) -> tuple:
+    """returns a cleared figure template for the style of config"""
+    pool = _templates.setdefault(config.get("name"), [])
+    if FIGURE_TEMPLATES and pool:
+        template = pool.pop()
+        fig, price_ax, volume_ax, rc = template
+        # artists created while drawing read the rc params of this style
+        plt.rcParams.update(rc)
+        _clear_axes(price_ax)
+        _clear_axes(volume_ax)
     else:
-        for ap in config.get("weekly_price_addplots", []):
-            addplots.append(
-                mpf.make_addplot(df[ap[0]], ax=price_ax, color=ap[1], width=ap[2])
-            )
-        for ap in config.get("weekly_volume_addplots", []):
-            addplots.append(
-                mpf.make_addplot(df[ap[0]], ax=volume_ax, color=ap[1], width=ap[2])
-            )
+        template = _new_template(config)
+        _set_tick_params(*template[1:3])
+    return template
+
+
+def _release_template(config: dict, template: tuple) -> None:
+    pool = _templates[config.get("name")]
+    if FIGURE_TEMPLATES and config.get("name") and len(pool) < MAX_TEMPLATES_PER_STYLE:
+        pool.append(template)
+    else:
+        plt.close(template[0])
+
+
+def _create_chart_with_config(df: pd.DataFrame, config: dict, finviz=None) -> bytes:
+    """renders df with config on a figure template and returns the encoded image"""
+    thres = 0.1
+    with metrics.timed("pivots"):
+        df["max"] = df.high[peak_valley_pivots(np.array(df.high), thres, -thres) == 1]
+        df["min"] = df.low[peak_valley_pivots(np.array(df.low), thres, -thres) == -1]
+
+    template = _acquire_template(config)
+    try:
+        return _draw_chart(df, config, finviz, *template[:3])
+    finally:
+        _release_template(config, template)
+
+
+def _plot_candles(df: pd.DataFrame, config: dict, price_ax, volume_ax) -> None:
+    """plots the bars, volume and addplots of config with mplfinance"""
+    price_addplots, volume_addplots = _get_addplots(config)
+    addplots = []
+    for ap in price_addplots:
+        addplots.append(
+            mpf.make_addplot(df[ap[0]], ax=price_ax, color=ap[1], width=ap[2])
+        )
+    for ap in volume_addplots:
+        addplots.append(
+            mpf.make_addplot(df[ap[0]], ax=volume_ax, color=ap[1], width=ap[2])
+        )
 
     mpf.plot(
         df[["open", "high", "low", "close", "volume"]],
@@ -290,7 +495,176 @@ def _create_chart_with_config(
         datetime_format="%Y-%m-%d",
         scale_width_adjustment={"volume": 0.7},
         update_width_config={"ohlc_ticksize": 0.5, "ohlc_linewidth": 1.5},
+        warn_too_much_data=len(df) + 1,
+    )
+
+
+def _width(name: str, bars: int) -> float:
+    return float(np.interp(bars, _WIDTH_BARS, _WIDTHS[name]))
+
+
+def _updown_colors(colors: dict, up: np.ndarray, alpha=None) -> np.ndarray:
+    """returns the rgba color of every bar, colors["up"] where up"""
+    rgba = mcolors.to_rgba_array([colors["up"], colors["down"]], alpha)
+    return np.where(up[:, None], rgba[0], rgba[1])
+
+
+def _darken(rgba: np.ndarray, amount=0.9) -> np.ndarray:
+    """scales the lightness of rgba colors like mplfinance's default volume edges"""
+    out = rgba.copy()
+    for color in np.unique(rgba, axis=0):
+        h, l, s = colorsys.rgb_to_hls(*color[:3])
+        out[(rgba == color).all(axis=1), :3] = colorsys.hls_to_rgb(h, min(1, amount * l), s)
+    return out
+
+
+def _plot_collections(df: pd.DataFrame, config: dict, price_ax, volume_ax) -> None:
+    """plots the same bars, volume and addplots as _plot_candles, drawing
+    them directly as a few batched collections instead of through mpf.plot"""
+    style = config["mpl_cfg"]
+    colors = style["marketcolors"]
+    opens, highs, lows, closes, volumes = (
+        df[col].to_numpy(dtype=float) for col in ("open", "high", "low", "close", "volume")
+    )
+    bars = len(df)
+    x = np.arange(bars, dtype=float)
+    up = opens < closes
+
+    if config.get("plot_type", "candle") == "ohlc":
+        segments = np.concatenate(
+            [
+                np.stack([np.c_[x, lows], np.c_[x, highs]], axis=1),
+                np.stack([np.c_[x - OHLC_TICKSIZE, opens], np.c_[x, opens]], axis=1),
+                np.stack([np.c_[x, closes], np.c_[x + OHLC_TICKSIZE, closes]], axis=1),
+            ]
+        )
+        ohlc = _updown_colors(colors["ohlc"], up)
+        price_ax.add_collection(
+            LineCollection(segments, colors=np.tile(ohlc, (3, 1)), linewidths=OHLC_LINEWIDTH)
+        )
+    else:
+        delta = _width("candle", bars) / 2
+        linewidth = _width("candle_line", bars)
+        body_low, body_high = np.minimum(opens, closes), np.maximum(opens, closes)
+        wicks = np.concatenate(
+            [
+                np.stack([np.c_[x, lows], np.c_[x, body_low]], axis=1),
+                np.stack([np.c_[x, highs], np.c_[x, body_high]], axis=1),
+            ]
+        )
+        bodies = np.stack(
+            [
+                np.c_[x - delta, opens],
+                np.c_[x - delta, closes],
+                np.c_[x + delta, closes],
+                np.c_[x + delta, opens],
+            ],
+            axis=1,
+        )
+        wick = _updown_colors(colors["wick"], up)
+        price_ax.add_collection(
+            LineCollection(wicks, colors=np.tile(wick, (2, 1)), linewidths=linewidth)
+        )
+        price_ax.add_collection(
+            PolyCollection(
+                bodies,
+                facecolors=_updown_colors(colors["candle"], up, colors.get("alpha", 1)),
+                edgecolors=_updown_colors(colors["edge"], up),
+                linewidths=linewidth,
+            )
+        )
+    # the x range mplfinance reserves around the bars, margins are added later
+    spacing = (x[-1] - x[0]) / bars
+    price_ax.update_datalim(
+        ((x[0] - spacing, np.nanmin(lows)), (x[-1] + spacing, np.nanmax(highs)))
+    )
+
+    volume_up = up
+    if colors.get("vcdopcod", False):
+        volume_up = np.concatenate([up[:1], closes[1:] > closes[:-1]])
+    volume_colors = _updown_colors(colors["volume"], volume_up)
+    if colors["volume"] == colors["vcedge"]:
+        volume_edges = _darken(volume_colors)
+    else:
+        volume_edges = _updown_colors(colors["vcedge"], volume_up)
+    half = _width("volume", bars) * VOLUME_WIDTH_SCALE / 2
+    zeros = np.zeros(bars)
+    volume_ax.add_collection(
+        PolyCollection(
+            np.stack(
+                [
+                    np.c_[x - half, zeros],
+                    np.c_[x - half, volumes],
+                    np.c_[x + half, volumes],
+                    np.c_[x + half, zeros],
+                ],
+                axis=1,
+            ),
+            facecolors=volume_colors,
+            edgecolors=volume_edges,
+            linewidths=_width("volume_line", bars),
+        )
+    )
+    volume_ax.set_ylim(0.3 * np.nanmin(volumes), 1.1 * np.nanmax(volumes))
+
+    price_addplots, volume_addplots = _get_addplots(config)
+    for ax, addplots in ((price_ax, price_addplots), (volume_ax, volume_addplots)):
+        for column, color, width in addplots:
+            ax.plot(x, df[column].to_numpy(), color=color, linewidth=width)
+
+    for ax in (price_ax, volume_ax):
+        ax.set_axisbelow(True)
+        ax.tick_params(axis="x", rotation=0)
+    # the axes share x, and with it the formatter
+    dates = df.index.strftime("%Y-%m-%d")
+    price_ax.xaxis.set_major_formatter(
+        mticker.FuncFormatter(
+            lambda value, _: dates[int(np.round(value))]
+            if 0 <= np.round(value) < bars
+            else ""
+        )
     )
+    if style.get("y_on_right", False):
+        price_ax.yaxis.set_label_position("right")
+        price_ax.yaxis.tick_right()
+    else:
+        price_ax.yaxis.set_label_position("left")
+        price_ax.yaxis.tick_left()
+    price_ax.autoscale_view()
+
+
+_ENGINES = {"mpf": _plot_candles, "fast": _plot_collections}
+
+
+def _draw_chart(df: pd.DataFrame, config: dict, finviz: dict, fig, price_ax, volume_ax):
+    kwargs = {
+        "horizontalalignment": "center",
+        "color": config["foreground"],
+        "fontsize": 8,
+        "backgroundcolor": config["background"],
+        "bbox": {
+            "boxstyle": "square",
+            "fc": config["background"],
+            "ec": "none",
+            "pad": 0,
+            "alpha": 0,
+        },
+    }
+    rvol = df["rvol"].to_numpy()
+    volume = df["volume"].to_numpy()
+    for i in _get_rvol_peaks(rvol):
+        volume_ax.text(
+            i + 1,
+            volume[i] * 1.1,
+            str(int(rvol[i] * 100)) + "%\n" + str(np.round(volume[i] / 1e6, 1)) + "M",
+            **kwargs,
+            verticalalignment="bottom",
+        )
+
+    stock_name = df["ticker"].values[-1]
+    engine = config.get("engine", DEFAULT_ENGINE)
+    with metrics.timed(f"{engine}_plot"):
+        _ENGINES[engine](df, config, price_ax, volume_ax)
     ticker_watermark = (
         f'{stock_name}{", 1W" if config.get("weekly", False) else ", 1D"}'
     )
@@ -330,7 +704,7 @@ def _create_chart_with_config(
     price_ax.text(
         0.5,
         0.68,
-        df["short_name"].values[-1],
+        df["short_name"].values[-1] if "short_name" in df.columns else "",
         transform=price_ax.transAxes,
         horizontalalignment="center",
         verticalalignment="center",
@@ -379,24 +753,130 @@ def _create_chart_with_config(
     price_ax.margins(x=0.02, y=0.1)
     price_ax.set_ylim(top=0.4 * (df["high"].max() - df["low"].min()) + df["high"].max())
     fig.subplots_adjust(hspace=0, wspace=0)
-    plt.savefig(img_path, bbox_inches="tight")
-    plt.close("all")
-
-
-def create_chart_image(ticker, weekly, config_type, offset):
-    """generates chart config and creates chart image for provided ticker"""
-    if config_type.lower() == "qullamaggie":
-        config = get_qullamaggie_config()
-    elif config_type.lower() == "ibd":
-        config = get_ibd_config()
-    elif config_type.lower() == "light":
-        config = get_light_config()
-    elif config_type.lower() == "stockbee":
-        config = get_stockbee_config()
-    else:
-        config = get_qullamaggie_config()
-    stock_data = ut.get_stock_data(ticker=ticker, weekly=weekly, offset=offset)
-    _create_chart_with_config(stock_data, config)
+    with metrics.timed("encode"):
+        return _encode_figure(fig, config.get("image_format", "png"), config.get("dpi"))
+
+
+def warm_up(styles=None) -> None:
+    """renders a synthetic chart per style, which builds the font cache and
+    the figure templates of this process"""
+    for name in styles or STYLES:
+        config = get_style(name)
+        df = ut.get_synthetic_stock_data(indicators=get_required_indicators(config))
+        _create_chart_with_config(df, config, {})
+
+
+def chart_config(config_type, weekly, image_format=None, dpi=None, engine=None) -> dict:
+    """returns the named style config with the given overrides"""
+    config = get_style(config_type)
+    config["weekly"] = weekly
+    if image_format is not None:
+        if image_format not in IMAGE_FORMATS:
+            raise Exception(f"Unknown image format: {image_format}")
+        config["image_format"] = image_format
+    if dpi is not None:
+        config["dpi"] = dpi
+    check_dpi(config.get("dpi"))
+    if engine is not None:
+        config["engine"] = engine
+    if config.get("engine", DEFAULT_ENGINE) not in RENDER_ENGINES:
+        raise Exception(f"Unknown render engine: {config['engine']}")
+    return config
+
+
+def create_chart_from_data(stock_data: pd.DataFrame, config: dict, finviz=None) -> bytes:
+    """renders stock data shaped like get_stock_data's with config, returns the encoded image"""
+    with metrics.timed("draw"):
+        return _create_chart_with_config(stock_data.copy(), config, finviz)
+
+
+def _timed_call(stage: str, func, *args):
+    with metrics.timed(stage):
+        return func(*args)
+
+
+# fetch threads of this process, a late fetch keeps running and fills its cache
+_gather_pool = None
+
+
+def _gather(ticker, weekly, offset, indicators, deadline) -> tuple:
+    """fetches the price data, meta and fundamentals of ticker concurrently,
+    returns the price data with the meta, the fundamentals and the names of
+    the optional sources that missed the deadline"""
+    global _gather_pool
+    if _gather_pool is None:
+        _gather_pool = ThreadPoolExecutor(GATHER_THREADS, thread_name_prefix="gather")
+    start = time.monotonic()
+    optional = {
+        "meta": _gather_pool.submit(_timed_call, "meta", ut.get_meta_yfinance, ticker),
+        "fundamentals": _gather_pool.submit(
+            _timed_call, "fundamentals", get_fundamentals, ticker
+        ),
+    }
+    with metrics.timed("stock_data"):
+        stock_data = ut.get_price_data(
+            ticker=ticker, weekly=weekly, offset=offset, indicators=indicators
+        )
+    timeout = None if deadline is None else max(0.0, deadline - (time.monotonic() - start))
+    done, _ = wait(optional.values(), timeout=timeout)
+    results = {}
+    missing = []
+    for name, future in optional.items():
+        if future not in done:
+            missing.append(name)
+            metrics.inc("degraded_total", source=name)
+        elif future.exception() is None:
+            results[name] = future.result()
+    if "meta" in results:
+        ut.add_meta(stock_data, results["meta"])
+    return stock_data, results.get("fundamentals", {}), tuple(missing)
+
+
+def create_chart(
+    ticker,
+    weekly,
+    config_type,
+    offset,
+    image_format=None,
+    dpi=None,
+    engine=None,
+    deadline=GATHER_DEADLINE,
+) -> tuple:
+    """looks up the style config and creates the chart image of ticker, returns
+    the encoded image and the optional sources (meta, fundamentals) it was
+    rendered without because they missed deadline, None waits for them"""
+    config = chart_config(config_type, weekly, image_format, dpi, engine)
+    stock_data, finviz, missing = _gather(
+        ticker,
+        weekly,
+        offset,
+        get_required_indicators(config),
+        deadline,
+    )
+    with metrics.timed("draw"):
+        image = _create_chart_with_config(stock_data, config, finviz)
+    return image, missing
+
+
+def create_chart_image(
+    ticker,
+    weekly,
+    config_type,
+    offset,
+    img_path="img.png",
+    image_format=None,
+    dpi=None,
+    engine=None,
+) -> bytes:
+    """looks up the style config and creates chart image for provided ticker,
+    returns the encoded image and also writes it to img_path unless None"""
+    image, _ = create_chart(
+        ticker, weekly, config_type, offset, image_format, dpi, engine, deadline=None
+    )
+    if img_path is not None:
+        with open(img_path, "wb") as f:
+            f.write(image)
+    return image
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""Module providing scheduled watchlist pre-rendering"""
+
+import asyncio
+import datetime as dt
+import importlib
+import logging
+import time
+
+import metrics
+from cache import ImageCache
+from render_pool import ChartRequest, RenderPool
+
+# NY market times to pre-render at on weekdays: after the close settled and before the open
+SCHEDULE = ("16:30", "08:30")
+# (weekly, style, offset) combinations rendered per ticker, matching the defaults of
+# !chart and !wchart so their cache keys hit
+COMBINATIONS = ((False, "qullamaggie", 9), (True, "qullamaggie", 40))
+# CPU budget: low-priority worker processes
+WORKERS = 1
+NICENESS = 10
+# upstream budget: tickers fetched per minute and per batched download
+TICKERS_PER_MINUTE = 120
+BATCH_SIZE = 20
+# seconds to wait between checks while live renders are in flight
+IDLE_POLL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def load_watchlist(path: str) -> list:
+    """returns the tickers of a watchlist file, one per line, # starts a comment"""
+    with open(path, encoding="utf-8") as f:
+        tickers = [line.split("#")[0].strip().upper() for line in f]
+    return list(dict.fromkeys(ticker for ticker in tickers if ticker))
+
+
+def next_run(schedule, now: dt.datetime, tz) -> dt.datetime:
+    """returns the next weekday time of schedule ("HH:MM" in tz) after now"""
+    now = now.astimezone(tz)
+    for days in range(8):
+        day = now.date() + dt.timedelta(days=days)
+        if day.weekday() >= 5:
+            continue
+        for at in sorted(schedule):
+            hour, minute = map(int, at.split(":"))
+            run = dt.datetime.combine(day, dt.time(hour, minute), tzinfo=tz)
+            if run > now:
+                return run
+    raise Exception(f"Invalid pre-render schedule: {schedule}")
+
+
+class Prerenderer:
+    """pre-renders a watchlist into the rendered-chart cache on a schedule, on
+    niced workers that wait while the live pool is rendering"""
+
+    def __init__(
+        self,
+        watchlist,
+        cache: ImageCache,
+        live_pool: RenderPool,
+        schedule=SCHEDULE,
+        combinations=COMBINATIONS,
+        workers=WORKERS,
+        tickers_per_minute=TICKERS_PER_MINUTE,
+        batch_size=BATCH_SIZE,
+    ) -> None:
+        self._watchlist = watchlist
+        self._schedule = schedule
+        self._combinations = combinations
+        self._tickers_per_minute = tickers_per_minute
+        self._batch_size = batch_size
+        self._live_pool = live_pool
+        self._pool = RenderPool(
+            max_workers=workers,
+            cache=cache,
+            warm_up=False,
+            niceness=NICENESS,
+            renders=live_pool.renders,
+        )
+        self._task = None
+
+    def start(self) -> None:
+        """starts the schedule loop on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def stop(self) -> None:
+        """stops the schedule loop and the workers"""
+        if self._task is not None:
+            self._task.cancel()
+        self._pool.shutdown()
+
+    def _tickers(self) -> list:
+        if isinstance(self._watchlist, str):
+            return load_watchlist(self._watchlist)
+        return list(self._watchlist)
+
+    async def _loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        bar_store = await loop.run_in_executor(None, importlib.import_module, "bar_store")
+        while True:
+            now = dt.datetime.now(bar_store.MARKET_TZ)
+            run = next_run(self._schedule, now, bar_store.MARKET_TZ)
+            logger.info("next watchlist pre-render at %s", run.isoformat())
+            await asyncio.sleep((run - now).total_seconds())
+            try:
+                await self.run()
+            except Exception as e:
+                logger.warning("watchlist pre-render failed: %s", e)
+
+    async def _wait_for_idle(self) -> None:
+        while self._live_pool.in_flight:
+            await asyncio.sleep(IDLE_POLL)
+
+    async def run(self) -> dict:
+        """refreshes and pre-renders the watchlist once, returns the rendered
+        and failed chart counts"""
+        tickers = self._tickers()
+        intervals = {"1wk" if weekly else "1d" for weekly, _, _ in self._combinations}
+        counts = {"rendered": 0, "failed": 0}
+        start = time.perf_counter()
+        for i in range(0, len(tickers), self._batch_size):
+            batch = tickers[i : i + self._batch_size]
+            batch_start = time.monotonic()
+            await self._wait_for_idle()
+            for interval in sorted(intervals):
+                await self._pool.prefetch(batch, interval)
+            for ticker in batch:
+                requests = [
+                    ChartRequest(ticker, weekly, style, offset)
+                    for weekly, style, offset in self._combinations
+                ]
+                await self._wait_for_idle()
+                for result in await self._pool.render_many(requests):
+                    if isinstance(result, Exception):
+                        counts["failed"] += 1
+                        metrics.inc("prerendered_total", result="failed")
+                        logger.debug("pre-render of %s failed: %s", ticker, result)
+                    else:
+                        counts["rendered"] += 1
+                        metrics.inc("prerendered_total", result="rendered")
+            # stay within the upstream budget
+            budget = len(batch) * 60 / self._tickers_per_minute
+            await asyncio.sleep(max(0.0, budget - (time.monotonic() - batch_start)))
+        logger.info(
+            "pre-rendered %d charts of %d tickers in %.1fs, %d failed",
+            counts["rendered"],
+            len(tickers),
+            time.perf_counter() - start,
+            counts["failed"],
+        )
+        return counts
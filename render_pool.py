@@ -0,0 +1,315 @@
+"""Module providing the chart render execution layer"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+from cache import ImageCache
+import metrics
+from single_flight import SingleFlight
+
+# the data and plotting stack (pandas, yfinance, matplotlib, mplfinance) is
+# imported lazily so the bot process can connect before paying for it
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = ("png", "png8", "webp")
+# dpi bounds of a chart, the image buffer grows with the square of the dpi
+MIN_DPI = 50
+MAX_DPI = 300
+# months of history a chart can ask for, 50 years
+MAX_OFFSET = 600
+
+
+@dataclass(frozen=True)
+class ChartRequest:
+    """parameters of a single chart render"""
+
+    ticker: str
+    weekly: bool = False
+    style: str = "qullamaggie"
+    offset: int = 9
+    image_format: str = None
+    dpi: int = None
+    engine: str = None
+    # seconds the optional chart data may take, plot_lib.GATHER_DEADLINE if None.
+    # Not part of the request key: charts that missed data are not cached
+    deadline: float = None
+
+    @property
+    def interval(self) -> str:
+        """bar interval of the chart"""
+        return "1wk" if self.weekly else "1d"
+
+
+@dataclass(frozen=True)
+class ChartResult:
+    """rendered chart, the last bar of the data it shows and the metrics the
+    worker recorded while rendering it"""
+
+    image: bytes
+    last_bar: str
+    metrics: tuple = ()
+    missing: tuple = ()
+
+
+class ChartImage(bytes):
+    """encoded chart image rendered without the optional data sources in
+    missing, which did not arrive before the render deadline"""
+
+    def __new__(cls, image: bytes, missing=()):
+        self = super().__new__(cls, image)
+        self.missing = tuple(missing)
+        return self
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_dpi(dpi) -> None:
+    """raises unless dpi is None or a number from MIN_DPI to MAX_DPI"""
+    if dpi is not None and not (_is_number(dpi) and MIN_DPI <= dpi <= MAX_DPI):
+        raise Exception(f"dpi must be a number from {MIN_DPI} to {MAX_DPI}")
+
+
+def validate_request(request: ChartRequest) -> None:
+    """raises a message for the user when request has an unknown image format,
+    a dpi out of bounds or an offset that is not 1 to MAX_OFFSET months. It
+    imports nothing heavy and runs before a request is admitted"""
+    if request.image_format is not None and request.image_format not in IMAGE_FORMATS:
+        raise Exception(
+            f"Unknown image format: {request.image_format}, formats are {', '.join(IMAGE_FORMATS)}"
+        )
+    check_dpi(request.dpi)
+    if not (_is_number(request.offset) and 1 <= request.offset <= MAX_OFFSET):
+        raise Exception(f"offset must be a number of months from 1 to {MAX_OFFSET}")
+
+
+def request_key(request: ChartRequest) -> str:
+    """returns a key identifying the image request renders to"""
+    return "|".join(
+        [
+            request.ticker.strip().upper(),
+            "1W" if request.weekly else "1D",
+            request.style.lower(),
+            str(request.offset),
+            str(request.image_format),
+            str(request.dpi),
+            str(request.engine),
+        ]
+    )
+
+
+def cache_key(request: ChartRequest, last_bar) -> str:
+    """returns the rendered-chart cache key of request for the given last bar"""
+    return f"{request_key(request)}|{last_bar}"
+
+
+def render_chart(request: ChartRequest) -> ChartResult:
+    """renders the requested chart in memory, without the optional data that
+    misses the request's deadline"""
+    import bar_store
+    import plot_lib as pl
+
+    try:
+        with metrics.profiled(f"{request.ticker}-{request.interval}"):
+            with metrics.timed("chart"):
+                image, missing = pl.create_chart(
+                    request.ticker,
+                    request.weekly,
+                    request.style,
+                    request.offset,
+                    image_format=request.image_format,
+                    dpi=request.dpi,
+                    engine=request.engine,
+                    deadline=(
+                        pl.GATHER_DEADLINE if request.deadline is None else request.deadline
+                    ),
+                )
+    except Exception as e:
+        # the metrics travel back with the exception, it is pickled with its __dict__
+        e.metrics = tuple(metrics.drain())
+        raise
+    last_bar = bar_store.last_bar(request.ticker, request.interval)
+    return ChartResult(image, last_bar, tuple(metrics.drain()), missing)
+
+
+def render_frame(request: ChartRequest, stock_data, fundamentals) -> ChartResult:
+    """renders the requested chart from already gathered stock data and fundamentals"""
+    import plot_lib as pl
+
+    try:
+        config = pl.chart_config(
+            request.style, request.weekly, request.image_format, request.dpi, request.engine
+        )
+        image = pl.create_chart_from_data(stock_data, config, fundamentals)
+    except Exception as e:
+        e.metrics = tuple(metrics.drain())
+        raise
+    return ChartResult(image, None, tuple(metrics.drain()))
+
+
+def _init_worker(warm_up=True, niceness=0) -> None:
+    """worker initializer: lowers the worker priority by niceness, imports the
+    render stack and pre-renders a chart per style before the worker takes
+    traffic, worker metrics are buffered and returned with each result"""
+    if niceness and hasattr(os, "nice"):
+        os.nice(niceness)
+    metrics.start_buffer()
+    if not warm_up:
+        return
+    try:
+        import plot_lib as pl
+
+        pl.warm_up()
+    except Exception as e:
+        logger.warning("render worker warm-up failed: %s", e)
+    metrics.drain()
+
+
+def _probe_worker() -> tuple:
+    """returns the pid and the seconds a synthetic chart takes on a warm worker"""
+    import plot_lib as pl
+
+    start = time.perf_counter()
+    pl.warm_up(styles=[pl.DEFAULT_STYLE])
+    elapsed = time.perf_counter() - start
+    metrics.drain()
+    return os.getpid(), elapsed
+
+
+def image_extension(image: bytes) -> str:
+    """returns the file extension matching the encoded image"""
+    return "webp" if image[8:12] == b"WEBP" else "png"
+
+
+class RenderPool:
+    """bounded process pool that renders charts off the asyncio event loop,
+    serving repeat requests from an optional rendered-chart cache"""
+
+    def __init__(
+        self,
+        max_workers=None,
+        cache: ImageCache = None,
+        warm_up=True,
+        niceness=0,
+        renders: SingleFlight = None,
+    ) -> None:
+        self._max_workers = max_workers or os.cpu_count()
+        self._initargs = (warm_up, niceness)
+        self._executor = self._new_executor()
+        self._cache = cache
+        # pools sharing a cache should share renders too, so they never render
+        # the same chart twice at the same time
+        self.renders = renders or SingleFlight("render")
+        self.in_flight = 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    async def warm_up(self) -> dict:
+        """starts and warms every worker, returns the seconds a synthetic chart
+        takes per warm worker pid"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, importlib.import_module, "bar_store")
+        # workers are spawned on demand, one probe per worker starts them all
+        probes = [
+            loop.run_in_executor(self._executor, _probe_worker)
+            for _ in range(self._max_workers)
+        ]
+        return dict(await asyncio.gather(*probes))
+
+    def _cached(self, request: ChartRequest):
+        import bar_store
+
+        last_bar = bar_store.last_bar(request.ticker, request.interval)
+        return self._cache.get(cache_key(request, last_bar))
+
+    async def cached(self, request: ChartRequest):
+        """returns the cached image of request if its data did not change, otherwise
+        None. The lookup reads the bar store and the cache from disk off the event loop"""
+        if self._cache is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self._cached, request)
+
+    async def render(self, request: ChartRequest) -> bytes:
+        """renders request in a worker process and returns the image, a
+        ChartImage with the missing sources if it is degraded. Identical
+        requests arriving while it renders share the render"""
+        image = await self.cached(request)
+        if image is not None:
+            return image
+        return await self.renders.do(request_key(request), lambda: self._render(request))
+
+    async def _execute(self, func, *args) -> ChartResult:
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        self.in_flight += 1
+        try:
+            with metrics.timed("render"):
+                result = await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # a worker died, e.g. killed out of memory, and took the pool with it.
+            # The renders in flight fail, the next ones get a new pool
+            if self._executor is executor:
+                logger.warning("render worker died, restarting the render pool")
+                executor.shutdown(wait=False)
+                self._executor = self._new_executor()
+            raise Exception("The chart renderer crashed, try again") from None
+        except Exception as e:
+            metrics.merge(getattr(e, "metrics", ()))
+            raise
+        finally:
+            self.in_flight -= 1
+        metrics.merge(result.metrics)
+        return result
+
+    async def _render(self, request: ChartRequest) -> bytes:
+        result = await self._execute(render_chart, request)
+        if result.missing:
+            # degraded, the next request renders the complete chart
+            return ChartImage(result.image, result.missing)
+        if self._cache is not None and result.last_bar is not None:
+            self._cache.set(cache_key(request, result.last_bar), result.image)
+        return result.image
+
+    async def render_frame(self, request: ChartRequest, stock_data, fundamentals) -> bytes:
+        """renders request from stock data shaped like get_stock_data's in a
+        worker process, for charts whose data is kept up to date by the caller"""
+        result = await self._execute(render_frame, request, stock_data, fundamentals)
+        return result.image
+
+    async def prefetch(self, tickers, interval="1d") -> set:
+        """refreshes the stored bars and fundamentals of tickers with batched
+        downloads so the renders find them fresh, returns the upper-case
+        tickers with data"""
+        import bar_store
+        import fundamentals
+
+        loop = asyncio.get_running_loop()
+        bars, _ = await asyncio.gather(
+            loop.run_in_executor(None, bar_store.get_many, tickers, interval),
+            loop.run_in_executor(None, fundamentals.fetch_fundamentals, tickers),
+        )
+        return set(bars)
+
+    async def render_many(self, requests: list) -> list:
+        """renders requests in parallel, returns an image or exception per request"""
+        return await asyncio.gather(
+            *(self.render(request) for request in requests), return_exceptions=True
+        )
+
+    def shutdown(self) -> None:
+        """stops the worker processes, dropping renders that have not started"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
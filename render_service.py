@@ -0,0 +1,257 @@
+"""Module providing a standalone chart render service and its client
+
+A render service node renders charts on its own worker pool and cache:
+
+    python render_service.py --port 8081 --workers 4
+
+Bots pass the nodes as render_endpoints and spread their renders over them.
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import time
+import zlib
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+from cache import ImageCache
+from render_pool import (
+    ChartImage,
+    ChartRequest,
+    RenderPool,
+    image_extension,
+    request_key,
+    validate_request,
+)
+from single_flight import SingleFlight
+
+TIMEOUT = 60
+# response header listing the sources a degraded chart was rendered without
+MISSING_HEADER = "X-Chart-Missing"
+# seconds an unreachable endpoint is tried last
+DOWN_COOLDOWN = 10
+logger = logging.getLogger(__name__)
+
+
+def _chart_request(params: dict) -> ChartRequest:
+    fields = {field.name for field in dataclasses.fields(ChartRequest)}
+    unknown = set(params) - fields
+    if unknown or "ticker" not in params:
+        raise ValueError(f"Invalid render parameters: {sorted(unknown) or 'no ticker'}")
+    request = ChartRequest(**params)
+    try:
+        validate_request(request)
+    except Exception as e:
+        raise ValueError(str(e)) from None
+    return request
+
+
+def create_app(pool: RenderPool) -> web.Application:
+    """returns the render service app serving pool"""
+    routes = web.RouteTableDef()
+
+    @routes.post("/render")
+    async def render(request: web.Request) -> web.Response:
+        try:
+            chart = _chart_request(await request.json())
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+        try:
+            image = await pool.render(chart)
+        except Exception as e:
+            # the message is meant for the user, like the bot's own errors
+            return web.Response(status=422, text=str(e))
+        headers = {}
+        if getattr(image, "missing", ()):
+            headers[MISSING_HEADER] = ",".join(image.missing)
+        return web.Response(
+            body=image, content_type=f"image/{image_extension(image)}", headers=headers
+        )
+
+    @routes.post("/prefetch")
+    async def prefetch(request: web.Request) -> web.Response:
+        params = await request.json()
+        tickers = await pool.prefetch(params["tickers"], params.get("interval", "1d"))
+        return web.json_response(sorted(tickers))
+
+    @routes.post("/warm_up")
+    async def warm_up(request: web.Request) -> web.Response:
+        latencies = await pool.warm_up()
+        return web.json_response({str(pid): seconds for pid, seconds in latencies.items()})
+
+    @routes.get("/health")
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"in_flight": pool.in_flight})
+
+    @routes.get("/metrics")
+    async def metrics_(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.add_routes(routes)
+
+    async def shutdown(app: web.Application) -> None:
+        pool.shutdown()
+
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+class RemoteRenderPool:
+    """render pool client sending renders to render service endpoints, to the
+    one with the fewest outstanding requests, the ticker's own node on ties so
+    its bars and fundamentals stay hot there. Unreachable nodes are tried last
+    for DOWN_COOLDOWN seconds"""
+
+    def __init__(self, endpoints, timeout=TIMEOUT) -> None:
+        self._endpoints = [endpoint.rstrip("/") for endpoint in endpoints]
+        self._outstanding = dict.fromkeys(self._endpoints, 0)
+        self._down_until = dict.fromkeys(self._endpoints, 0.0)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+        self.renders = SingleFlight("render")
+        self.in_flight = 0
+
+    def _order(self, ticker: str) -> list:
+        def affinity(endpoint):
+            return zlib.crc32(f"{endpoint}|{ticker.upper()}".encode())
+
+        now = time.monotonic()
+        return sorted(
+            self._endpoints,
+            key=lambda endpoint: (
+                self._down_until[endpoint] > now,
+                self._outstanding[endpoint],
+                -affinity(endpoint),
+            ),
+        )
+
+    def _client(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self._timeout)
+        return self._session
+
+    async def _request(self, method: str, path: str, ticker="", payload=None) -> tuple:
+        """returns the body and headers of the first endpoint answering"""
+        error = None
+        for endpoint in self._order(ticker):
+            self._outstanding[endpoint] += 1
+            try:
+                async with self._client().request(
+                    method, f"{endpoint}{path}", json=payload
+                ) as response:
+                    status, headers = response.status, response.headers
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc("upstream_failures_total", upstream="render_service")
+                logger.warning("render service %s failed: %r", endpoint, e)
+                self._down_until[endpoint] = time.monotonic() + DOWN_COOLDOWN
+                error = e
+                continue
+            finally:
+                self._outstanding[endpoint] -= 1
+            if status != 200:
+                raise Exception(body.decode(errors="replace"))
+            return body, headers
+        raise Exception(f"No render service reachable: {error!r}")
+
+    async def warm_up(self) -> dict:
+        """warms every endpoint, returns the seconds a synthetic chart takes per
+        endpoint and worker pid"""
+
+        async def warm(endpoint):
+            async with self._client().post(f"{endpoint}/warm_up") as response:
+                response.raise_for_status()
+                latencies = await response.json()
+            return {f"{endpoint}/{pid}": seconds for pid, seconds in latencies.items()}
+
+        latencies = {}
+        for result in await asyncio.gather(*(warm(e) for e in self._endpoints)):
+            latencies.update(result)
+        return latencies
+
+    async def cached(self, request: ChartRequest):
+        """charts are cached on the endpoints"""
+        return None
+
+    async def render(self, request: ChartRequest) -> bytes:
+        """renders request on an endpoint and returns the image, a ChartImage
+        if it is degraded. Identical requests arriving while it renders share
+        the render"""
+        return await self.renders.do(request_key(request), lambda: self._render(request))
+
+    async def _render(self, request: ChartRequest) -> bytes:
+        self.in_flight += 1
+        try:
+            with metrics.timed("render"):
+                image, headers = await self._request(
+                    "POST", "/render", request.ticker, dataclasses.asdict(request)
+                )
+        finally:
+            self.in_flight -= 1
+        missing = headers.get(MISSING_HEADER)
+        return ChartImage(image, missing.split(",")) if missing else image
+
+    async def prefetch(self, tickers, interval="1d") -> set:
+        """prefetches the bars and fundamentals of tickers on their endpoints"""
+        groups = {}
+        for ticker in tickers:
+            groups.setdefault(self._order(ticker)[0], []).append(ticker)
+        results = await asyncio.gather(
+            *(
+                self._request(
+                    "POST", "/prefetch", group[0], {"tickers": group, "interval": interval}
+                )
+                for group in groups.values()
+            )
+        )
+        return {ticker for body, _ in results for ticker in json.loads(body)}
+
+    async def render_many(self, requests: list) -> list:
+        """renders requests in parallel, returns an image or exception per request"""
+        return await asyncio.gather(
+            *(self.render(request) for request in requests), return_exceptions=True
+        )
+
+    def shutdown(self) -> None:
+        """closes the connections to the endpoints"""
+        if self._session is not None:
+            asyncio.ensure_future(self._session.close())
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--watchlist", help="pre-render the tickers of this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cache = ImageCache("charts")
+    pool = RenderPool(max_workers=args.workers, cache=cache)
+    app = create_app(pool)
+    if args.watchlist:
+        from prerender import Prerenderer
+
+        prerenderer = Prerenderer(args.watchlist, cache, pool)
+
+        async def start(app: web.Application) -> None:
+            prerenderer.start()
+
+        async def stop(app: web.Application) -> None:
+            prerenderer.stop()
+
+        app.on_startup.append(start)
+        app.on_cleanup.append(stop)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    _main()
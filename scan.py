@@ -0,0 +1,131 @@
+"""Module providing vectorized scans of the stored universe
+
+Loads the latest daily bars of every ticker in the bar store into one array,
+one row per ticker, computes the indicators at the last bar of all rows at once
+and filters and ranks the tickers on them:
+
+    python scan.py "rvol>2" "adr20>0.04" "close>sma50" --sort rvol
+
+A filter compares a bar field (open, high, low, close, volume) or indicator
+with a number or another field or indicator.
+"""
+
+import argparse
+import operator
+import re
+import sys
+
+import metrics
+
+FIELDS = ("open", "high", "low", "close", "volume")
+# two-character operators first so >= is not read as >
+OPERATORS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
+_FILTER = re.compile(r"([\w.+-]+?)(>=|<=|>|<)([\w.+-]+)")
+DEFAULT_SORT = "rvol"
+SCAN_LIMIT = 25
+
+
+def _operand(text: str):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_filter(text: str) -> tuple:
+    """parses a filter like rvol>2 or close>sma50 into (left, operator, right),
+    a number operand as float and a name operand as str"""
+    match = _FILTER.fullmatch(text.strip().lower())
+    if match is None:
+        raise Exception(f"Invalid filter: {text}, filters look like rvol>2 or close>sma50")
+    left, op, right = match.groups()
+    return _operand(left), op, _operand(right)
+
+
+def scan(filters, sort=DEFAULT_SORT, tickers=None, limit=SCAN_LIMIT) -> dict:
+    """scans tickers, every ticker in the bar store if None, on their stored
+    daily bars. filters are parsed filters or their text and must all hold at
+    the last bar. Returns the date of the last bar, the counts of tickers
+    scanned, skipped for lacking that bar and matched, and the first limit
+    matches ranked by sort descending with the values of the fields used"""
+    import numpy as np
+    import bar_store
+    import indicators as ind
+
+    filters = [parse_filter(f) if isinstance(f, str) else f for f in filters]
+    names = [sort] + [x for left, _, right in filters for x in (left, right) if isinstance(x, str)]
+    names = list(dict.fromkeys(names))
+    unknown = [name for name in names if name not in FIELDS and name not in ind.INDICATORS]
+    if unknown:
+        raise Exception(
+            f"Unknown scan fields: {unknown}, fields are {list(FIELDS) + list(ind.INDICATORS)}"
+        )
+    indicators = [name for name in names if name in ind.INDICATORS]
+    with metrics.timed("scan_load"):
+        found, bars = bar_store.load_recent(
+            bar_store.stored_tickers() if tickers is None else tickers,
+            ind.warmup(indicators) + 1,
+        )
+    if not found:
+        raise Exception("No stored bars to scan, chart or batch render tickers first")
+    # tickers without the latest bar are stale or delisted, their values are of an older day
+    last = bars["date"][:, -1]
+    current = last == last.max()
+    found = [ticker for ticker, keep in zip(found, current) if keep]
+    bars = bars[current]
+    with metrics.timed("scan_indicators"):
+        values = {name: bars[name][:, -1] for name in names if name in FIELDS}
+        values.update(ind.latest_indicators(bars, indicators))
+    matched = np.ones(len(found), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for left, op, right in filters:
+            matched &= OPERATORS[op](
+                values[left] if isinstance(left, str) else left,
+                values[right] if isinstance(right, str) else right,
+            )
+    rows = np.flatnonzero(matched)
+    # nan sort values rank last
+    ranked = rows[np.argsort(-values[sort][rows], kind="stable")][:limit]
+    return {
+        "date": str(np.datetime64(int(last.max()), "ns").astype("datetime64[D]")),
+        "scanned": len(found),
+        "skipped": int((~current).sum()),
+        "matched": len(rows),
+        "matches": [
+            {"ticker": found[row], **{name: float(values[name][row]) for name in names}}
+            for row in ranked
+        ],
+    }
+
+
+def format_result(result: dict) -> str:
+    """returns the ranked matches of a scan result as a text table"""
+    lines = [
+        f"{result['date']}: {result['matched']} of {result['scanned']} tickers match"
+        + (f", {result['skipped']} without that bar skipped" if result["skipped"] else "")
+    ]
+    for match in result["matches"]:
+        values = "  ".join(
+            f"{name} {value:.4g}" for name, value in match.items() if name != "ticker"
+        )
+        lines.append(f"{match['ticker']:6s} {values}")
+    return "\n".join(lines)
+
+
+def _main() -> int:
+    from prerender import load_watchlist
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("filters", nargs="*", help="filters like rvol>2, quoted for the shell")
+    parser.add_argument("--sort", default=DEFAULT_SORT)
+    parser.add_argument("--limit", type=int, default=SCAN_LIMIT)
+    parser.add_argument("--tickers", help="file with one ticker per line, default the bar store")
+    args = parser.parse_args()
+
+    tickers = load_watchlist(args.tickers) if args.tickers else None
+    print(format_result(scan(args.filters, args.sort, tickers, args.limit)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -1,28 +1,71 @@
 """Module for scraping"""
 
+import logging
 import time
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 import requests
+from requests.adapters import HTTPAdapter
+from cache import TTLCache
+import metrics
 
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
+}
+MAX_ATTEMPTS = 3
+BACKOFF = 0.25
+DEADLINE = 3.0
+FUNDAMENTALS_TTL = 12 * 60 * 60
+# requests waiting on a failed fetch give up instead of retrying it for this long
+FAILURE_TTL = 30
 
-def scrape_finviz(ticker):
-    status_code = 0
+_session = requests.Session()
+_session.headers.update(HEADERS)
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+# fundamentals by lower-case ticker and the tickers whose fetch just failed,
+# shared with the bulk screener provider in fundamentals.py
+fundamentals_cache = TTLCache("finviz", FUNDAMENTALS_TTL)
+failures_cache = TTLCache("finviz_failures", FAILURE_TTL)
+logger = logging.getLogger(__name__)
+
+
+def http_get(url: str, deadline=DEADLINE):
+    """GET url with bounded retries and exponential backoff, returns None
+    when no 200/404 response arrived within deadline seconds"""
+    end = time.monotonic() + deadline
+    backoff = BACKOFF
+    for attempt in range(MAX_ATTEMPTS):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = _session.get(url, timeout=remaining)
+            if response.status_code in (200, 404):
+                return response
+            logger.warning("received status code %s for url: %s", response.status_code, url)
+        except requests.RequestException as e:
+            logger.warning("request failed: %s for url: %s", e, url)
+        if attempt == MAX_ATTEMPTS - 1:
+            break
+        time.sleep(max(min(backoff, end - time.monotonic()), 0))
+        backoff *= 2
+    return None
+
+
+def _snapshot_table(content: bytes):
+    # only hand the snapshot table to the parser, not the whole page
+    pos = content.find(b"snapshot-table2")
+    start = content.rfind(b"<table", 0, pos)
+    end = content.find(b"</table>", pos)
+    if pos == -1 or start == -1 or end == -1:
+        strainer = SoupStrainer("table", {"class": "snapshot-table2"})
+        return BeautifulSoup(content, "html.parser", parse_only=strainer).find("table")
+    return BeautifulSoup(content[start : end + 8], "html.parser").find("table")
+
+
+def parse_finviz(content: bytes, ticker: str) -> dict:
+    """parses the snapshot table of a finviz quote page"""
     result = {}
-    url = f"https://finviz.com/quote.ashx?t={ticker}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
-    }
-    response = requests.get(url, headers=headers, timeout=5)
-    while status_code != 200:
-        response = requests.get(url, headers=headers, timeout=5)
-        status_code = response.status_code
-        if status_code != 200:
-            print(f"Received status code: {status_code} for ticker: {ticker}")
-            time.sleep(10)
-        if status_code == 404:
-            return result
-    soup = BeautifulSoup(response.content, "html.parser")
-    tab_body = soup.find("table", {"class": "snapshot-table2"})
+    tab_body = _snapshot_table(content)
     if isinstance(tab_body, Tag):
         rows = tab_body.find_all("tr")
         scrape = []
@@ -37,28 +80,57 @@ def scrape_finviz(ticker):
             scrape_dict[k] = v
 
         result["ticker"] = ticker.lower()
-        result["sales_surprise"] = _format_pct(scrape_dict["sales_surprise"])
-        result["eps_surprise"] = _format_pct(scrape_dict["eps_surprise"])
-        result["forward_pe"] = _format_float(scrape_dict["forward_pe"])
-        result["pe"] = _format_float(scrape_dict["pe"])
-        result["peg"] = _format_float(scrape_dict["peg"])
-        result["ps"] = _format_float(scrape_dict["ps"])
-        result["pb"] = _format_float(scrape_dict["pb"])
-        result["pfcf"] = _format_float(scrape_dict["pfcf"])
-        result["insider_own"] = _format_pct(scrape_dict["insider_own"])
-        result["inst_own"] = _format_pct(scrape_dict["inst_own"])
-        result["inst_trans"] = _format_pct(scrape_dict["inst_trans"])
+        result["sales_surprise"] = format_pct(scrape_dict["sales_surprise"])
+        result["eps_surprise"] = format_pct(scrape_dict["eps_surprise"])
+        result["forward_pe"] = format_float(scrape_dict["forward_pe"])
+        result["pe"] = format_float(scrape_dict["pe"])
+        result["peg"] = format_float(scrape_dict["peg"])
+        result["ps"] = format_float(scrape_dict["ps"])
+        result["pb"] = format_float(scrape_dict["pb"])
+        result["pfcf"] = format_float(scrape_dict["pfcf"])
+        result["insider_own"] = format_pct(scrape_dict["insider_own"])
+        result["inst_own"] = format_pct(scrape_dict["inst_own"])
+        result["inst_trans"] = format_pct(scrape_dict["inst_trans"])
         result["shares_float"] = _format_shares_float(scrape_dict["shs_float"])
-        result["short_float"] = _format_pct(scrape_dict["short_float"])
-        result["roa"] = _format_pct(scrape_dict["roa"])
-        result["roe"] = _format_pct(scrape_dict["roe"])
-        result["roi"] = _format_pct(scrape_dict["roi"])
-        result["gross_margin"] = _format_pct(scrape_dict["gross_margin"])
-        result["oper_margin"] = _format_pct(scrape_dict["oper_margin"])
-        result["profit_margin"] = _format_pct(scrape_dict["profit_margin"])
+        result["short_float"] = format_pct(scrape_dict["short_float"])
+        result["roa"] = format_pct(scrape_dict["roa"])
+        result["roe"] = format_pct(scrape_dict["roe"])
+        result["roi"] = format_pct(scrape_dict["roi"])
+        result["gross_margin"] = format_pct(scrape_dict["gross_margin"])
+        result["oper_margin"] = format_pct(scrape_dict["oper_margin"])
+        result["profit_margin"] = format_pct(scrape_dict["profit_margin"])
     return result
 
 
+def scrape_finviz(ticker):
+    """returns the finviz fundamentals of ticker, served from the cache when
+    fresh and empty if finviz did not answer in time"""
+    key = ticker.lower()
+    result = fundamentals_cache.get(key)
+    if result is not None:
+        return result
+    with fundamentals_cache.lock(key):
+        # concurrent requests for ticker wait here and reuse the first one's fetch
+        result = fundamentals_cache.get(key)
+        if result is not None:
+            metrics.inc("coalesced_total", flight="finviz")
+            return result
+        if failures_cache.get(key) is not None:
+            return {}
+        with metrics.timed("finviz_fetch"):
+            response = http_get(f"https://finviz.com/quote.ashx?t={ticker}")
+        if response is None:
+            metrics.inc("upstream_failures_total", upstream="finviz")
+            failures_cache.set(key, True)
+            return {}
+        with metrics.timed("finviz_parse"):
+            result = (
+                parse_finviz(response.content, ticker) if response.status_code == 200 else {}
+            )
+        fundamentals_cache.set(key, result)
+        return result
+
+
 def _replace(s):
     return (
         s.replace("(", "")
@@ -70,7 +142,8 @@ def _replace(s):
     )
 
 
-def _format_pct(value):
+def format_pct(value):
+    """parses a finviz percentage like 12.5% to a fraction, 0 if it is not one"""
     try:
         ret = float(value.replace("%", "")) / 100
     except:
@@ -78,7 +151,8 @@ def _format_pct(value):
     return ret
 
 
-def _format_float(value):
+def format_float(value):
+    """parses a finviz number, 0 if it is not one"""
     try:
         ret = float(value)
     except:
@@ -0,0 +1,55 @@
+"""Module providing request coalescing"""
+
+import asyncio
+import os
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+class SingleFlight:
+    """coalesces concurrent calls with the same key: callers arriving while a
+    call is in flight await its result instead of starting another one"""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._flights = {}
+
+    def _done(self, key, task: asyncio.Future) -> None:
+        self._flights.pop(key, None)
+        # retrieve the exception so it is not reported when every caller left
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func):
+        """returns the result of func() or of the in-flight call for key,
+        a cancelled caller does not cancel the call others are waiting for"""
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            metrics.inc("coalesced_total", flight=self._name)
+        return await asyncio.shield(task)
+
+
+@contextmanager
+def file_lock(path: str):
+    """holds an exclusive lock on path across threads and processes, so the
+    first one to fetch a resource does it and the others wait and reuse it"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,125 @@
+"""token buckets, admission and the priority queue of admission.py"""
+
+import asyncio
+
+import pytest
+
+import admission
+from render_pool import ChartRequest, validate_request
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Pool:
+    """render pool whose cache holds the tickers in cached and whose renders
+    finish when released"""
+
+    def __init__(self, cached=()) -> None:
+        self._cached = set(cached)
+        self.rendered = []
+        self.release = None
+
+    async def cached(self, request):
+        return b"cached" if request.ticker in self._cached else None
+
+    async def render(self, request):
+        self.rendered.append(request.ticker)
+        await self.release.wait()
+        return request.ticker.encode()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_never_goes_into_debt(clock):
+    bucket = admission.TokenBucket(6, 0.2)
+    assert bucket.allows(1000)
+    bucket.take(1000)
+    assert not bucket.allows(1)
+    # empty, not 994 units in debt
+    assert bucket.retry_after(1) == pytest.approx(5)
+    clock.now += 30
+    assert bucket.full()
+
+
+def test_huge_request_does_not_lock_out_the_guild(clock):
+    scheduler = admission.RenderScheduler(Pool(), concurrency=1)
+    huge = ChartRequest("nvda", weekly=True, offset=600, dpi=300)
+    assert admission.estimate_cost(huge) > admission.GUILD_BUCKET[0]
+    scheduler.admit([huge], "spammer", "guild")
+    with pytest.raises(Exception, match="Slow down"):
+        scheduler.admit([ChartRequest("nvda")], "spammer", "guild")
+    # the guild lost at most a user's burst, everyone else still gets charts
+    for user in range(5):
+        scheduler.admit([ChartRequest("nvda")] * 5, user, "guild")
+
+
+def test_cached_charts_cost_nothing(clock):
+    async def run():
+        scheduler = admission.RenderScheduler(Pool(cached={"aapl"}), concurrency=1)
+        for _ in range(50):
+            images = await scheduler.admit_uncached([ChartRequest("aapl")], "user", "guild")
+            assert images == [b"cached"]
+        images = await scheduler.admit_uncached(
+            [ChartRequest("aapl"), ChartRequest("nvda")], "user", "guild"
+        )
+        assert images == [b"cached", None]
+
+    asyncio.run(run())
+
+
+def test_full_idle_buckets_are_pruned(clock):
+    scheduler = admission.RenderScheduler(Pool(), concurrency=1)
+    for user in range(100):
+        scheduler.admit([ChartRequest("nvda")], user, user)
+    assert len(scheduler._buckets) == 200
+    clock.now += admission.PRUNE_INTERVAL + 60
+    scheduler.admit([ChartRequest("nvda")], "last", None)
+    assert list(scheduler._buckets) == [("user", "last")]
+
+
+def test_queue_order_and_limit(clock):
+    async def run():
+        pool = Pool()
+        pool.release = asyncio.Event()
+        scheduler = admission.RenderScheduler(pool, concurrency=1, max_queue=4)
+        running = scheduler.enqueue(ChartRequest("first"), "a")
+        heavy = scheduler.enqueue(ChartRequest("heavy", offset=120), "b")
+        spam = [scheduler.enqueue(ChartRequest(f"spam{i}"), "a") for i in range(2)]
+        cheap = scheduler.enqueue(ChartRequest("cheap"), "c")
+        assert scheduler.position(running) == 0
+        # heavy requests and users with requests queued wait behind the others
+        assert [scheduler.position(f) for f in (spam[0], cheap, spam[1], heavy)] == [1, 2, 3, 4]
+        with pytest.raises(Exception, match="busy"):
+            scheduler.admit([ChartRequest("more")], "d")
+        pool.release.set()
+        await asyncio.gather(running, heavy, cheap, *spam)
+        assert pool.rendered == ["first", "spam0", "cheap", "spam1", "heavy"]
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "fields, message",
+    [
+        ({"dpi": 4000}, "dpi"),
+        ({"dpi": "abc"}, "dpi"),
+        ({"offset": 100000}, "offset"),
+        ({"offset": "abc"}, "offset"),
+        ({"image_format": "gif"}, "image format"),
+    ],
+)
+def test_invalid_requests_are_refused_before_admission(fields, message):
+    with pytest.raises(Exception, match=message):
+        validate_request(ChartRequest("nvda", **fields))
+    validate_request(ChartRequest("nvda", dpi=300, offset=600, image_format="webp"))
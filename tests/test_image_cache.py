@@ -0,0 +1,38 @@
+"""ImageCache under concurrent readers and writers"""
+
+import threading
+
+import cache
+
+
+def test_concurrent_get_and_set(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    images = cache.ImageCache("charts", max_items=4, max_bytes=64 * 1024)
+    errors = []
+    gets = 2000
+
+    def read():
+        try:
+            for i in range(gets):
+                images.get(f"key{i % 16}")
+        except Exception as e:
+            errors.append(e)
+
+    def write():
+        try:
+            for i in range(500):
+                images.set(f"key{i % 16}", bytes(1024))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    threads += [threading.Thread(target=write) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = images.stats()
+    assert not errors
+    assert stats["hits"] + stats["misses"] == 4 * gets
+    assert stats["memory_items"] <= 4
+    assert stats["disk_bytes"] <= 64 * 1024
@@ -0,0 +1,59 @@
+"""parity of the resampled weekly and monthly bars with pandas and the recorded weekly bars"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bar_store
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench_fixtures"
+)
+RULES = {"1wk": "W-MON", "1mo": "MS"}
+
+
+def _fixture(name: str) -> pd.DataFrame:
+    return bar_store._to_frame(np.load(os.path.join(FIXTURES_DIR, name)))
+
+
+def _expected(df: pd.DataFrame, interval: str) -> pd.DataFrame:
+    """pandas' aggregation of the daily bars, periods without bars left out"""
+    return (
+        df.resample(RULES[interval], label="left", closed="left")
+        .agg(bar_store.AGGREGATION)
+        .dropna(subset=["open"])
+    )
+
+
+@pytest.mark.parametrize("interval", ["1wk", "1mo"])
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_pandas(interval, seed):
+    df = _fixture("bars_1d.npy")
+    # holidays and missing days, some whole weeks
+    rng = np.random.default_rng(seed)
+    df = df[rng.random(len(df)) > 0.1 * seed]
+    resampled = bar_store.resample(df, interval)
+    pd.testing.assert_frame_equal(resampled, _expected(df, interval), check_freq=False)
+
+
+def test_partial_current_week():
+    df = _fixture("bars_1d.npy").iloc[:-2]
+    resampled = bar_store.resample(df, "1wk")
+    week = df[df.index >= resampled.index[-1]]
+    assert resampled["close"].iloc[-1] == week["close"].iloc[-1]
+    assert resampled["volume"].iloc[-1] == pytest.approx(week["volume"].sum())
+
+
+def test_recorded_weekly_bars():
+    """bars_1wk.npy holds yahoo's weekly bars or, for the synthetic fixtures,
+    pandas' aggregation of bars_1d.npy, never bar_store.resample's output"""
+    resampled = bar_store.resample(_fixture("bars_1d.npy"), "1wk")
+    recorded = _fixture("bars_1wk.npy")
+    # the current week is still partial in one of them
+    weeks = resampled.index.intersection(recorded.index)[:-1]
+    assert len(weeks) == len(recorded) - 1
+    np.testing.assert_allclose(
+        resampled.loc[weeks].to_numpy(), recorded.loc[weeks].to_numpy(), rtol=1e-3
+    )
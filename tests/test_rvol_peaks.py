@@ -0,0 +1,49 @@
+"""parity of the vectorized rvol peak detection with the per-bar loop it replaced"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import plot_lib as pl
+
+
+def _loop_peaks(df: pd.DataFrame, window_volume=10) -> list:
+    """the rvol label loop of _create_chart_with_config before vectorization"""
+    peaks = []
+    for i in range(window_volume, len(df)):
+        df_slice = df[i - window_volume : i + window_volume].copy()
+        if df["rvol"].iloc[i] > 1.5 and df_slice["rvol"].max() <= df["rvol"].iloc[i]:
+            peaks.append(i)
+    return peaks
+
+
+def _frame(rvol: np.ndarray) -> pd.DataFrame:
+    return pd.DataFrame({"rvol": rvol}, index=pd.date_range("2020-01-01", periods=len(rvol)))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_frames(seed):
+    rng = np.random.default_rng(seed)
+    rvol = rng.lognormal(0, 0.5, rng.integers(0, 120))
+    # nan runs like the warm-up of rvol and missing volume
+    for start in rng.integers(0, max(len(rvol), 1), rng.integers(0, 4)):
+        rvol[start : start + rng.integers(1, 15)] = np.nan
+    # ties, rounded values repeat within a window
+    if seed % 2:
+        rvol = np.round(rvol, 1)
+    expected = _loop_peaks(_frame(rvol))
+    assert list(pl._get_rvol_peaks(rvol)) == expected
+
+
+@pytest.mark.parametrize("length", range(0, 22))
+def test_frames_shorter_than_the_window(length):
+    rvol = np.full(length, 3.0)
+    rvol[length // 2 :] = 4.0
+    assert list(pl._get_rvol_peaks(rvol)) == _loop_peaks(_frame(rvol))
+
+
+def test_ties_and_all_nan():
+    rvol = np.array([np.nan] * 12 + [2.0, 2.0, 1.0] + [np.nan] * 10 + [2.0] * 15)
+    assert list(pl._get_rvol_peaks(rvol)) == _loop_peaks(_frame(rvol))
+    rvol = np.full(30, np.nan)
+    assert list(pl._get_rvol_peaks(rvol)) == _loop_peaks(_frame(rvol)) == []
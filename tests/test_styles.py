@@ -0,0 +1,31 @@
+"""style files in styles/ are compiled at import, a bad one must not break the others"""
+
+import json
+
+import pytest
+
+import plot_lib as pl
+
+
+def _write(directory, name, content):
+    path = directory / name
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+    return path
+
+
+def test_bad_style_files_are_skipped(tmp_path, caplog):
+    _write(tmp_path, "good.json", {"extends": "ibd", "log": True})
+    _write(tmp_path, "dark.json", {"extends": "dark"})
+    _write(tmp_path, "broken.json", "{not json")
+    _write(tmp_path, "bare.json", {"log": True})
+    styles, mpf_styles = pl._compile_styles(str(tmp_path))
+    assert "good" in styles and styles["good"]["log"] is True
+    assert set(styles) == set(pl.BUILTIN_STYLES) | {"good"}
+    assert set(mpf_styles) == set(styles)
+    assert len([r for r in caplog.records if "skipping style" in r.message]) == 3
+
+
+def test_unknown_base_style(tmp_path):
+    path = _write(tmp_path, "mine.json", {"extends": "dark"})
+    with pytest.raises(Exception, match="Unknown base style 'dark'"):
+        pl.load_style_file(str(path))
@@ -1,49 +1,111 @@
 """Module providing utils"""
 
 import datetime as dt
+import numpy as np
 import yfinance as yf
 import pandas as pd
+import bar_store
+import indicators as ind
+from cache import TTLCache
+import metrics
 
+META_TTL = 24 * 60 * 60
 
-def get_stock_data(ticker, period="max", weekly=False, offset=12) -> pd.DataFrame:
-    """get stock data from yfinance and add some technical indicators and other meta"""
-    tick = yf.Ticker(ticker)
-    df = tick.history(period=period, interval="1d" if not weekly else "1wk")
+_meta = TTLCache("yfinance_meta", META_TTL)
+
+
+def get_price_data(
+    ticker, period="max", weekly=False, offset=12, indicators=None
+) -> pd.DataFrame:
+    """get stock data from the bar store and add the requested technical
+    indicators (all registered ones if None)"""
+    names = list(ind.INDICATORS) if indicators is None else list(indicators)
+    with metrics.timed("bars"):
+        df = bar_store.get_bars(ticker, interval="1d" if not weekly else "1wk", period=period)
     if df.empty:
         raise Exception(f"No data found for ticker: {ticker}")
-    df.index.name = "date"
-    df = df.tz_localize(None)
-    df.columns = [col.lower() for col in df.columns]
+    today = dt.datetime.now().date()
+    start_date = today - pd.offsets.DateOffset(months=offset)
+    first = df.index.searchsorted(start_date)
+    df = df.iloc[max(first - ind.warmup(names), 0) :].copy()
     df["ticker"] = ticker.upper()
-    df["sma10"] = df["close"].rolling(10).mean()
-    df["sma20"] = df["close"].rolling(20).mean()
-    df["sma30"] = df["close"].rolling(30).mean()
-    df["ema9"] = df["close"].ewm(span=9, adjust=False).mean()
-    df["ema21"] = df["close"].ewm(span=21, adjust=False).mean()
-    df["ema65"] = df["close"].ewm(span=65, adjust=False).mean()
-    df["sma50"] = df["close"].rolling(50).mean()
-    df["adr20"] = (df["high"] / df["low"] - 1).ewm(span=20, adjust=False).mean()
-    df["volume_sma50"] = df["volume"].rolling(50).mean()
-    df["volume_sma10"] = df["volume"].rolling(10).mean()
-    df["rvol"] = df["volume"] / df["volume_sma50"]
+    with metrics.timed("indicators"):
+        ind.add_indicators(df, names)
+    df = df[(df.index >= start_date)]
+    if df.empty or len(df) == 0:
+        raise Exception(f"No data found for ticker: {ticker}")
+    return df
+
+
+def add_meta(df: pd.DataFrame, meta: dict) -> pd.DataFrame:
+    """adds the name, industry and sector of meta to df, nothing if meta lacks them"""
     try:
-        meta = tick.info
         df["short_name"] = meta["shortName"].replace(".", "")
         df["industry"] = meta["industry"]
         df["sector"] = meta["sector"]
     except:
         pass
-    today = dt.datetime.now().date()
-    start_date = today - pd.offsets.DateOffset(months=offset)
-    df = df[(df.index >= start_date)]
-    if df.empty or len(df) == 0:
-        raise Exception(f"No data found for ticker: {ticker}")
     return df
 
 
+def get_stock_data(
+    ticker, period="max", weekly=False, offset=12, indicators=None
+) -> pd.DataFrame:
+    """get stock data from the bar store and add the requested technical
+    indicators (all registered ones if None) and other meta"""
+    df = get_price_data(ticker, period, weekly, offset, indicators)
+    try:
+        with metrics.timed("meta"):
+            meta = get_meta_yfinance(ticker)
+    except:
+        return df
+    return add_meta(df, meta)
+
+
 def get_meta_yfinance(ticker: str) -> dict:
-    """get stocke meta data from yfinance"""
-    return yf.Ticker(ticker).info
+    """get stock meta data from yfinance, cached since it changes at most daily"""
+    key = ticker.lower()
+    meta = _meta.get(key)
+    if meta is not None:
+        return meta
+    with _meta.lock(key):
+        # concurrent requests for ticker wait here and reuse the first one's fetch
+        meta = _meta.get(key)
+        if meta is not None:
+            metrics.inc("coalesced_total", flight="meta")
+            return meta
+        meta = yf.Ticker(ticker).info
+        _meta.set(key, meta)
+        return meta
+
+
+def get_synthetic_stock_data(
+    bars=200, weekly=False, indicators=None, ticker="TEST", seed=0
+) -> pd.DataFrame:
+    """returns a random-walk frame shaped like get_stock_data's, no network needed"""
+    names = list(ind.INDICATORS) if indicators is None else list(indicators)
+    rng = np.random.default_rng(seed)
+    n = bars + ind.warmup(names)
+    freq = "W-MON" if weekly else "B"
+    index = pd.date_range(end=dt.date.today(), periods=n, freq=freq, name="date")
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+    open_ = close * (1 + rng.normal(0, 0.01, n))
+    df = pd.DataFrame(
+        {
+            "open": open_,
+            "high": np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, n))),
+            "low": np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, n))),
+            "close": close,
+            "volume": rng.lognormal(15, 0.5, n),
+        },
+        index=index,
+    )
+    df["ticker"] = ticker
+    ind.add_indicators(df, names)
+    df["short_name"] = f"{ticker} Inc"
+    df["industry"] = "Synthetic"
+    df["sector"] = "Synthetic"
+    return df.iloc[-bars:]
 
 
 if __name__ == "__main__":